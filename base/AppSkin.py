@@ -1,9 +1,11 @@
 from typing import Optional
-import os
 import json
-from cachetools import TTLCache
+import logging
 
-from ..utils import skin_path_join
+from .. import utils
+from ..utils import skin_path_join, asset_exists, read_skin_file
+
+logger = logging.getLogger(__name__)
 
 
 def merge_into(base, overwrites):
@@ -14,9 +16,21 @@ def merge_into(base, overwrites):
             base[k] = v
 
 
+def read_skins_data() -> dict:
+    """
+    Read the skin map, from the skin bundle if available.
+    """
+    if utils.skin_bundle is not None:
+        return utils.skin_bundle.skins_data
+    return json.load(open(skin_path_join('skins.json'), 'r'))
+
+
 class AppSkin:
-    skins_data = json.load(open(skin_path_join('skins.json'), 'r'))
-    gui_skin_cache = TTLCache(1024, ttl=60)
+    skins_data = read_skins_data()
+
+    # Registry of loaded skins, as a map of (skin_id, locale) -> AppSkin
+    # Cleared by `reload` when the skin files change
+    gui_skin_cache = {}
 
     def __init__(self, skin_id, locale=None):
         # Global skin text identifier
@@ -36,6 +50,9 @@ class AppSkin:
 
         self.public = self.skin_data.get('public', False)
 
+        # Map of card_id -> flattened card data, see `for_card`
+        self._card_cache = {}
+
         if (guild_whitelist := self.skin_data.get('guild_whitelist', None)) is not None:
             self.guild_whitelist = set(int(item) for item in guild_whitelist)
         else:
@@ -51,34 +68,71 @@ class AppSkin:
         """
         Retrieve skin data from the given path, respecting localisation overwrites.
         """
-        data = json.load(open(skin_path_join(skin_path, 'skin.json'), 'r'))
+        if utils.skin_bundle is not None and (data := utils.skin_bundle.skin_data(skin_path, locale)) is not None:
+            return data
+        data = json.loads(read_skin_file(skin_path_join(skin_path, 'skin.json')))
         if locale:
             locale_path = skin_path_join(skin_path, f"skin_{locale}.json")
-            if os.path.exists(locale_path):
-                locale_data = json.load(open(locale_path, 'r'))
+            if asset_exists(locale_path):
+                locale_data = json.loads(read_skin_file(locale_path))
                 merge_into(data, locale_data)
         return data
 
     @classmethod
     def get(cls, skin_id, locale=None, use_cache=True):
-        if use_cache and skin_id in cls.gui_skin_cache:
-            appskin = cls.gui_skin_cache[(skin_id, locale)]
+        key = (skin_id, locale)
+        if use_cache and key in cls.gui_skin_cache:
+            appskin = cls.gui_skin_cache[key]
         else:
-            appskin = cls.gui_skin_cache[(skin_id, locale)] = cls(skin_id, locale=locale)
+            appskin = cls.gui_skin_cache[key] = cls(skin_id, locale=locale)
 
         return appskin
 
+    @classmethod
+    def preload(cls, locales=(None,)):
+        """
+        Load every skin in the skin map, in each of the given locales, into the skin registry.
+        """
+        for skin_id in cls.skins_data['skin_map']:
+            for locale in locales:
+                try:
+                    cls.get(skin_id, locale)
+                except Exception:
+                    logger.exception(f"Could not load skin {skin_id!r} in locale {locale!r}.")
+
+    @classmethod
+    def reload(cls):
+        """
+        Re-read the skin map, and forget all loaded skins.
+        """
+        cls.skins_data = read_skins_data()
+        cls.gui_skin_cache.clear()
+
     @classmethod
     def get_all(cls, use_cache=True):
         """
         Generator yielding all the available app skins.
         """
-        cls.skins_data = json.load(open(skin_path_join('skins.json'), 'r'))
+        cls.skins_data = read_skins_data()
 
         for skin_id in cls.skins_data['skin_map'].keys():
             yield cls(skin_id)
 
     def for_card(self, card_id):
+        """
+        The skin data for the given card, flattened over the parent skins,
+        with the asset `PATH` for the card in increasing priority order.
+        The result is cached, and a fresh copy returned to each caller.
+        """
+        if (data := self._card_cache.get(card_id, None)) is None:
+            if utils.skin_bundle is not None:
+                data = utils.skin_bundle.card_data(self.skin_path, self.locale, card_id)
+            if data is None:
+                data = self._flatten_card(card_id)
+            self._card_cache[card_id] = data
+        return {**data, 'PATH': list(data['PATH'])}
+
+    def _flatten_card(self, card_id):
         asset_path = []
         data = {}
         for parent in self.parents:
@@ -115,5 +169,5 @@ class AppSkin:
         if skin_id is not None and skin_id in cls.skins_data["skin_map"]:
             path = cls.skins_data["skin_map"][skin_id]
             data_path = skin_path_join(path, 'skin.json')
-            if os.path.exists(data_path):
+            if asset_exists(data_path):
                 return path
@@ -1,27 +1,82 @@
+import os
+import sys
 import time
 import math
+import hashlib
 import logging
+import threading
+from typing import Optional
 from io import BytesIO
 import asyncio
-from cachetools import LFUCache
+from contextvars import ContextVar
+from multiprocessing import shared_memory, resource_tracker
+from cachetools import LRUCache, TTLCache
 import aiohttp
 from PIL import Image
 
+from meta import conf
+
+from ..utils import image_nbytes, cache_put
+
+logger = logging.getLogger(__name__)
 
 avatars = None
 
-DISCORD_BASE = 'https://cdn.discordapp.com'
+# Connection pool limits for avatar requests
+AVATAR_CONNECTIONS = conf.gui.getint('avatar_connections', fallback=100)
+AVATAR_CONNECTIONS_PER_HOST = conf.gui.getint('avatar_connections_per_host', fallback=20)
+
+# Seconds to keep idle connections to the CDN open
+AVATAR_KEEPALIVE = conf.gui.getfloat('avatar_keepalive', fallback=30)
+
+# Total and connection timeouts for a single avatar request, in seconds
+AVATAR_TIMEOUT = conf.gui.getfloat('avatar_timeout', fallback=10)
+AVATAR_CONNECT_TIMEOUT = conf.gui.getfloat('avatar_connect_timeout', fallback=5)
+
+# Seconds to remember avatars which could not be fetched, before trying again
+AVATAR_FAILURE_TTL = conf.gui.getint('avatar_failure_ttl', fallback=60)
+
+# Avatar sizes requested by the cards, for which the default avatar is preloaded
+STANDARD_SIZES = (256, 512)
+
+# Smallest size to fetch avatars at, so that one fetched avatar serves every standard size
+MASTER_SIZE = max(STANDARD_SIZES)
+
+# Maximum total size of the decoded avatars, and of the resized avatars derived from them, in megabytes
+AVATAR_MASTER_CACHE_SIZE = conf.gui.getint('avatar_master_cache_size', fallback=128)
+AVATAR_CACHE_SIZE = conf.gui.getint('avatar_cache_size', fallback=256)
+
+# Whether to hand derived avatars to the workers through shared memory, rather than copying the pixels into each request
+# Shared avatars, including those evicted but not yet unlinked, are bounded by `AVATAR_CACHE_SIZE`
+SHARED_AVATARS = conf.gui.getboolean('shared_avatars', fallback=False)
+
+# Seconds to keep the shared memory of an evicted avatar, so requests already referencing it may still read it
+SHARED_AVATAR_LINGER = 120
+
+# Whether avatars for the current request may be sent through shared memory
+# Cleared when retrying a request whose shared avatars were unlinked before it rendered
+share_avatars = ContextVar('share_avatars', default=True)
+
+# Maximum total size of the decoded, and of the prepared (sized and masked), avatars kept in each worker, in megabytes
+AVATAR_WORKER_CACHE_SIZE = conf.gui.getint('avatar_worker_cache_size', fallback=64)
+AVATAR_PREP_CACHE_SIZE = conf.gui.getint('avatar_prep_cache_size', fallback=64)
+
+# Directory to keep fetched avatars in across restarts, if any, and the maximum size of the directory in megabytes
+AVATAR_CACHE_DIR = conf.gui.get('avatar_cache_dir', fallback=None)
+AVATAR_CACHE_DIR_SIZE = conf.gui.getint('avatar_cache_dir_size', fallback=1024)
+
+DISCORD_BASE = conf.gui.get('avatar_cdn_base', fallback='https://cdn.discordapp.com')
 AVATAR_PATH = '/avatars/{uid}/{avatar_hash}.{ext}?size={size}'
 DEFAULT_AVATAR_PATH = '/embed/avatars/{id}.png'
 
 
-async def avatar_from_cdn(userid, avatar_hash, ext, size):
+async def avatar_from_cdn(session, userid, avatar_hash, ext, size):
     if avatar_hash is None:
         url = DISCORD_BASE + DEFAULT_AVATAR_PATH.format(id=0)
     else:
         url = DISCORD_BASE + AVATAR_PATH.format(uid=userid, avatar_hash=avatar_hash, ext=ext, size=size)
 
-    async with aiohttp.ClientSession() as session:
+    try:
         async with session.get(url) as response:
             if response.status == 200:
                 return await response.read()
@@ -29,62 +84,382 @@ async def avatar_from_cdn(userid, avatar_hash, ext, size):
                 # TODO: Custom exception here, maybe replicate or use Discord's classes
                 # Although we don't want to propagate this one up the line
                 return None
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        logger.warning(f"Could not fetch avatar from {url!r}.", exc_info=True)
+        return None
+
+
+class AvatarDiskCache:
+    """
+    Persistent cache of fetched avatar data, stored as one file per (userid, hash, size) key.
+    Avatar hashes are immutable, so entries never go stale, and are only removed to bound the directory size.
+    The least recently used files are evicted first.
+
+    All methods block on the filesystem, and should be run in a thread.
+    """
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+        # Total size of the cached files, calculated on first write
+        self.size = None
+        self._lock = threading.Lock()
+
+    def _path(self, key):
+        name = hashlib.blake2b(repr(key).encode(), digest_size=16).hexdigest()
+        return os.path.join(self.directory, name[:2], f"{name}.png")
+
+    def read(self, key) -> Optional[bytes]:
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            # Mark as recently used
+            os.utime(path)
+            return data
+        except FileNotFoundError:
+            return None
+        except OSError:
+            logger.warning(f"Could not read cached avatar {key!r} from {path!r}.", exc_info=True)
+            return None
+
+    def write(self, key, data: bytes):
+        path = self._path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            try:
+                # Size of the file being replaced, if any
+                replaced = os.path.getsize(path)
+            except FileNotFoundError:
+                replaced = 0
+            os.replace(tmp_path, path)
+        except OSError:
+            logger.warning(f"Could not write cached avatar {key!r} to {path!r}.", exc_info=True)
+            return
+
+        with self._lock:
+            if self.size is None:
+                self.size = sum(size for _, size, _ in self._scan())
+            else:
+                self.size += len(data) - replaced
+            if self.size > self.max_bytes:
+                self._evict()
+
+    def _scan(self):
+        """
+        List the cached files, as tuples of (last use, size, path).
+        """
+        entries = []
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def _evict(self):
+        """
+        Remove the least recently used files, until the directory is comfortably under its maximum size.
+        """
+        entries = sorted(self._scan())
+        self.size = sum(size for _, size, _ in entries)
+        target = self.max_bytes * 0.9
+        removed = 0
+        for _, size, path in entries:
+            if self.size <= target:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self.size -= size
+            removed += 1
+        logger.info(f"Evicted {removed} avatars from the avatar cache directory {self.directory!r}.")
+
+
+def _master_size(entry):
+    _, image = entry
+    return image.width * image.height * 4
+
+
+class AvatarExpired(Exception):
+    """
+    Raised in a rendering worker when the shared memory of an avatar was unlinked before the worker read it.
+    """
+    pass
+
+
+def _create_segment(data) -> str:
+    """
+    Copy the given data into a new shared memory segment, and return the name of the segment.
+    The segment is not kept open, the server only holds its name until unlinking it.
+    """
+    shm = shared_memory.SharedMemory(create=True, size=max(len(data), 1))
+    try:
+        # Allocate the pages now, so a full /dev/shm raises here instead of killing the process with SIGBUS on write
+        os.posix_fallocate(shm._fd, 0, shm.size)
+        shm.buf[:len(data)] = data
+    except BaseException:
+        shm.close()
+        shm.unlink()
+        raise
+    name = shm.name
+    shm.close()
+    return name
+
+
+def _unlink_segment(name):
+    try:
+        shm = shared_memory.SharedMemory(name=name)
+    except FileNotFoundError:
+        return
+    shm.close()
+    shm.unlink()
+
+
+def _attach_segment(name):
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+    else:
+        shm = shared_memory.SharedMemory(name=name)
+        # The server process owns the segment and unlinks it,
+        # so stop this worker's resource tracker from unlinking it when the worker exits.
+        resource_tracker.unregister(shm._name, 'shared_memory')
+        return shm
+
+
+class SharedAvatarCache(LRUCache):
+    """
+    Cache of derived `AvatarImage`s, bounded by their decoded size.
+    Evicted avatars are passed to `release`, to free their shared memory.
+    """
+    def __init__(self, maxsize, release):
+        super().__init__(maxsize, getsizeof=lambda avatar: avatar.nbytes)
+        self.release = release
+
+    def popitem(self):
+        key, avatar = super().popitem()
+        self.release(avatar)
+        return key, avatar
 
 
 class Avatars:
+    """
+    Avatar manager, fetching avatars from the Discord CDN.
+
+    Each avatar is fetched and decoded once, as a master image of at least `MASTER_SIZE`,
+    and every requested size is derived from that master.
+    Derived avatars are kept decoded, and optionally in shared memory segments which the workers read directly.
+    """
     def __init__(self):
-        self.cache = LFUCache(1000)
-        self.default_avatar = None
+        # Map of (userid, hash) -> (fetched size, decoded RGBA master image)
+        self.masters = LRUCache(AVATAR_MASTER_CACHE_SIZE * 1024 * 1024, getsizeof=_master_size)
 
-    @staticmethod
-    async def _fetch_avatar(userid, avatar_hash, size):
+        # Map of segment name -> segment size, for every shared avatar segment not yet unlinked
+        self.segments: dict[str, int] = {}
+        self.shared_bytes = 0
+
+        # Map of (userid, hash, size) -> derived AvatarImage
+        self.cache = SharedAvatarCache(AVATAR_CACHE_SIZE * 1024 * 1024, self._release)
+
+        self._session = None
+
+        # Default avatars by size, kept for the lifetime of the manager
+        self.default_avatars = {}
+
+        # Keys (userid, hash) of avatars which could not be fetched recently
+        self.failed = TTLCache(10000, ttl=AVATAR_FAILURE_TTL)
+
+        # Map of (userid, hash, fetch size) -> fetch task, for masters currently being fetched
+        self._inflight: dict[tuple, asyncio.Task] = {}
+
+        # Fetched avatar data, kept across restarts
+        if AVATAR_CACHE_DIR:
+            self.disk = AvatarDiskCache(AVATAR_CACHE_DIR, AVATAR_CACHE_DIR_SIZE * 1024 * 1024)
+        else:
+            self.disk = None
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
         """
-        Fetch an avatar with the given `userid`, `avatar_hash`, and `size` from Discord.
+        Shared session for avatar requests, keeping connections to the CDN alive between requests.
+        Created on first use, since it must be bound to the running event loop.
         """
-        # TODO: Delete old avatars without waiting for cache to expire
-        request_size = 2**math.ceil(math.log2(size))
-        data = await avatar_from_cdn(userid, avatar_hash, 'png', request_size)
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=AVATAR_CONNECTIONS,
+                limit_per_host=AVATAR_CONNECTIONS_PER_HOST,
+                keepalive_timeout=AVATAR_KEEPALIVE,
+            )
+            timeout = aiohttp.ClientTimeout(total=AVATAR_TIMEOUT, connect=AVATAR_CONNECT_TIMEOUT)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        return self._session
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+        for name in list(self.segments):
+            self._unlink(name)
+        self.cache.clear()
+        self.default_avatars.clear()
 
-        # Convert to Image format
+    async def _fetch_avatar(self, userid, avatar_hash, size):
+        """
+        Fetch an avatar with the given `userid` and `avatar_hash` from Discord, at the given `size`.
+        The avatar cache directory is checked first, if configured.
+        Returns the decoded RGBA image, or `None` if the avatar could not be fetched.
+        """
+        key = (userid, avatar_hash, size)
+        data = None
+        if self.disk is not None:
+            data = await asyncio.to_thread(self.disk.read, key)
+        if not data:
+            data = await avatar_from_cdn(self.session, userid, avatar_hash, 'png', size)
+            if data and self.disk is not None:
+                await asyncio.to_thread(self.disk.write, key, data)
         if data:
             with BytesIO(data) as buffer:
-                buffer.seek(0)
-                with Image.open(buffer).convert('RGBA') as image:
-                    if size < image.width:
-                        image.thumbnail((size, size))
-                    elif size > image.width:
-                        image = image.resize((size, size))
-                    with BytesIO() as new_buffer:
-                        image.save(new_buffer, format='PNG')
-                        new_buffer.seek(0)
-                        data = new_buffer.getvalue()
-        return data
-
-    async def get_avatar(self, userid, avatar_hash, size):
-        # TODO: Potential optimisation for future, tweak what sizes of avatars we store
+                with Image.open(buffer) as image:
+                    return image.convert('RGBA')
+        return None
+
+    @staticmethod
+    def _derive(master, size):
+        """
+        Resize the master avatar image to the given size.
+        """
+        if size < master.width:
+            image = master.copy()
+            image.thumbnail((size, size))
+        elif size > master.width:
+            image = master.resize((size, size))
+        else:
+            image = master
+        return image
+
+    def _share(self, key, image) -> 'AvatarImage':
+        """
+        Wrap the derived avatar image for sending to the workers.
+        The pixels are copied into a new shared memory segment where enabled and within bounds,
+        and otherwise sent with the avatar.
+        """
+        data = image.tobytes()
+        size = max(len(data), 1)
+        if SHARED_AVATARS and self.shared_bytes + size <= AVATAR_CACHE_SIZE * 1024 * 1024:
+            try:
+                name = _create_segment(data)
+            except OSError:
+                logger.warning(f"Could not create shared memory for avatar {key!r}, sending it by value.", exc_info=True)
+            else:
+                self.segments[name] = size
+                self.shared_bytes += size
+                return AvatarImage(key, image.size, segment=name)
+        return AvatarImage(key, image.size, data=data)
+
+    def _release(self, avatar):
+        """
+        Unlink the shared memory of an avatar which is no longer cached,
+        after giving requests already referencing it time to render.
+        """
+        if avatar.segment in self.segments:
+            asyncio.get_running_loop().call_later(SHARED_AVATAR_LINGER, self._unlink, avatar.segment)
+
+    def _unlink(self, name):
+        if (size := self.segments.pop(name, None)) is not None:
+            self.shared_bytes -= size
+            _unlink_segment(name)
+
+    async def get_avatar(self, userid, avatar_hash, size) -> Optional['AvatarImage']:
         if avatar_hash is None:
             userid = None
-        key = userid, avatar_hash, size
 
-        if (cached := self.cache.get(key, None)) is not None:
-            result = cached
+        result = await self._get((userid, avatar_hash, size))
+        if result is None and avatar_hash is not None:
+            result = await self._get((None, None, size))
+        if result is None:
+            # Issue obtaining default avatar
+            logger.critical("Cannot retrieve default avatar from Discord CDN!")
+
+        return result
+
+    async def preload_defaults(self):
+        """
+        Fetch the default avatar at each of the standard sizes.
+        """
+        await asyncio.gather(*(self._get((None, None, size)) for size in STANDARD_SIZES))
+
+    async def _get(self, key):
+        """
+        Retrieve the avatar with the given (userid, hash, size) key from the caches,
+        or derive it from the master avatar.
+        """
+        shared = share_avatars.get()
+        cached = self.default_avatars.get(key, None) or self.cache.get(key, None)
+        if cached is not None and (shared or cached.segment is None):
             logging.debug(f"Avatar {key!r} obtained from cache")
-        else:
-            now = time.time()
-            result = await self._fetch_avatar(*key)
-            if result is not None:
-                self.cache[key] = result
-            diff = time.time() - now
-            logging.debug(f"Avatar {key!r} fetched from Discord CDN in {diff} seconds")
+            return cached
 
-        if result is None:
-            result = await self.get_avatar(None, None, size)
-            if result is None:
-                # Issue obtaining default avatar
-                logging.critical("Cannot retrieve default avatar from Discord CDN!")
+        userid, avatar_hash, size = key
+        master = await self._get_master(userid, avatar_hash, size)
+        if master is None:
+            return None
+        image = self._derive(master, size)
 
+        if not shared:
+            # Only for this request, any cached avatar keeps its shared memory
+            return AvatarImage(key, image.size, data=image.tobytes())
+
+        if (cached := self.default_avatars.get(key, None) or self.cache.get(key, None)) is not None:
+            # Derived by a concurrent request while fetching
+            return cached
+
+        result = self._share(key, image)
+        if avatar_hash is None:
+            self.default_avatars[key] = result
+        elif not cache_put(self.cache, key, result):
+            self._release(result)
         return result
 
+    async def _get_master(self, userid, avatar_hash, size):
+        """
+        Retrieve the decoded master avatar for the given user and hash, fetched at a size of at least `size`.
+        Concurrent requests for the same avatar share a single fetch.
+        """
+        master_key = (userid, avatar_hash)
+        if (entry := self.masters.get(master_key, None)) is not None and entry[0] >= size:
+            return entry[1]
+        if master_key in self.failed:
+            logging.debug(f"Avatar {master_key!r} recently failed to fetch, skipping")
+            return None
+
+        fetch_size = max(MASTER_SIZE, 2**math.ceil(math.log2(size)))
+        fetch_key = (userid, avatar_hash, fetch_size)
+        if (task := self._inflight.get(fetch_key, None)) is None:
+            task = self._inflight[fetch_key] = asyncio.create_task(self._load_master(*fetch_key))
+            task.add_done_callback(lambda _: self._inflight.pop(fetch_key, None))
+        else:
+            logging.debug(f"Avatar {master_key!r} already being fetched, waiting")
+        # Don't cancel the fetch for the other waiters if this request is cancelled
+        return await asyncio.shield(task)
+
+    async def _load_master(self, userid, avatar_hash, size):
+        now = time.time()
+        master = await self._fetch_avatar(userid, avatar_hash, size)
+        if master is None:
+            self.failed[(userid, avatar_hash)] = True
+        else:
+            cache_put(self.masters, (userid, avatar_hash), (size, master))
+        diff = time.time() - now
+        logging.debug(f"Avatar {(userid, avatar_hash)!r} fetched from Discord CDN at size {size} in {diff} seconds")
+        return master
+
     async def get_avatars(self, *keys):
         """
         Get the avatars listed in `keys`.
@@ -95,8 +470,8 @@ class Avatars:
             Tuple of (userid, avatar hash, requested size).
             A hash of `None` is allowed, and corresponds to the default avatar.
 
-        Returns: List[Optional[str]]
-            Returns a list of avatar bytestrings corresponding to the requested keys.
+        Returns: List[Optional[AvatarImage]]
+            Returns a list of avatar references corresponding to the requested keys.
             Avatars that are unretrievable or unknown will be returned as the default avatar, of the requested size.
         """
         futures = [asyncio.create_task(self.get_avatar(*key)) for key in keys]
@@ -104,6 +479,86 @@ class Avatars:
         return [future.result() for future in futures]
 
 
+# Map of avatar key -> decoded RGBA avatar image, in each rendering worker
+_worker_avatars = LRUCache(AVATAR_WORKER_CACHE_SIZE * 1024 * 1024, getsizeof=image_nbytes)
+
+# Map of (avatar key, mask key, size) -> prepared avatar image, in each rendering worker
+_prepared_avatars = LRUCache(AVATAR_PREP_CACHE_SIZE * 1024 * 1024, getsizeof=image_nbytes)
+
+
+class AvatarImage:
+    """
+    Reference to a decoded RGBA avatar, sent to a rendering worker, and identified by its (userid, hash, size) key.
+    The pixels are held by the server in the named shared memory `segment`,
+    or carried as raw `data` where shared memory is disabled or unavailable.
+    If the segment has already been unlinked, loading raises `AvatarExpired`, and the server retries the request by value.
+    Workers only read the pixels when the avatar is not already decoded or prepared in the worker.
+    """
+    __slots__ = ('key', 'size', 'segment', 'data')
+
+    def __init__(self, key, size, segment=None, data=None):
+        self.key = key
+        self.size = size
+        self.segment = segment
+        self.data = data
+
+    def __repr__(self):
+        return f"<AvatarImage key={self.key!r} size={self.size!r} segment={self.segment!r}>"
+
+    @property
+    def nbytes(self):
+        return self.size[0] * self.size[1] * 4
+
+    def _read(self) -> Image.Image:
+        if self.segment is None:
+            return Image.frombytes('RGBA', self.size, self.data)
+        try:
+            shm = _attach_segment(self.segment)
+        except FileNotFoundError:
+            raise AvatarExpired(self.key) from None
+        try:
+            view = shm.buf[:self.nbytes]
+            try:
+                return Image.frombytes('RGBA', self.size, view)
+            finally:
+                view.release()
+        finally:
+            shm.close()
+
+    def load(self) -> Image.Image:
+        """
+        The avatar as a new RGBA image.
+        """
+        if (image := _worker_avatars.get(self.key, None)) is None:
+            image = self._read()
+            if not cache_put(_worker_avatars, self.key, image):
+                return image
+        return image.copy()
+
+    def prepared(self, skin, mask_field, size=None) -> Image.Image:
+        """
+        The avatar sized to, and masked by, the given mask field of the skin,
+        and then shrunk to fit within `size`, if given.
+
+        Prepared avatars are cached in each worker, and shared between renders,
+        so the returned image must not be modified.
+        """
+        key = (self.key, (skin.fingerprint, mask_field), size)
+        if (avatar := _prepared_avatars.get(key, None)) is None:
+            mask = skin.fields[mask_field].value
+            avatar = self.load()
+            if avatar.size != mask.size:
+                if avatar.width > mask.width:
+                    avatar.thumbnail(mask.size)
+                if avatar.size != mask.size:
+                    avatar = avatar.resize(mask.size)
+            avatar.paste((0, 0, 0, 0), mask=mask)
+            if size is not None:
+                avatar.thumbnail(size)
+            cache_put(_prepared_avatars, key, avatar)
+        return avatar
+
+
 def avatar_manager():
     global avatars
     if avatars is None:
@@ -6,7 +6,7 @@ import logging
 
 from babel.translator import ctx_locale, LazyStr
 
-from ..utils import image_as_file
+from ..utils import image_as_file, RenderPriority
 from ..client import request
 from .Layout import Layout
 from .Skin import Skin
@@ -29,6 +29,12 @@ class Card:
 
     display_name: LazyStr
 
+    # Scheduling priority of requests for this card on the rendering server
+    priority: RenderPriority = RenderPriority.INTERACTIVE
+
+    # Seconds for which the rendering server may serve identical requests from its result cache
+    cache_ttl: int = 60
+
     # Abstract base class for a drawable Card
 
     def __init__(self, *args, **kwargs):
@@ -58,7 +64,7 @@ class Card:
                 return method(*args, **kwargs)
             return await cls.card_route(runner, args, kwargs)
         else:
-            return await request(route=cls.route, args=args, kwargs=kwargs)
+            return await request(route=cls.route, args=args, kwargs=kwargs, priority=cls.priority)
 
     @classmethod
     async def card_route(cls, runner, args, kwargs):
@@ -77,7 +83,6 @@ class Card:
         locale = kwargs['locale']
         ctx_locale.set(locale)
         with closing(cls.skin(cls.card_id, locale=locale, **kwargs.pop('skin', {}))) as skin:
-            # TODO: Consider caching/preloading skins in parent?
             skin.load()
             with closing(cls.layout(skin, *args, **kwargs)) as card:
                 response = card._execute_draw()
@@ -87,6 +92,15 @@ class Card:
 
         return response
 
+    @classmethod
+    def preload_skin(cls, locale=None):
+        """
+        Load the default skin for this card into the per-process skin cache.
+        Intended to be run on rendering worker startup, so that renders do not wait on loading skin assets.
+        """
+        ctx_locale.set(locale)
+        cls.skin.preload(cls.card_id, locale=locale)
+
     @classmethod
     def skin_args_for(cls, userid=None, guildid=None, **kwargs):
         """
@@ -2,7 +2,7 @@ import time
 import logging
 
 from PIL import Image, ImageColor
-from ..utils import resolve_asset_path, get_font
+from ..utils import resolve_asset_path, get_font, font_cache_info, open_asset, asset_cache_info
 from .AppSkin import AppSkin
 
 from babel.translator import ctx_translator
@@ -62,10 +62,7 @@ class AssetField(Field):
 
     def load(self):
         if self.path:
-            image = Image.open(self.path)
-            if self.convert:
-                image = image.convert(self.convert)
-            self.value = image
+            self.value = open_asset(self.path, self.convert)
         else:
             self.value = None
         return self
@@ -217,7 +214,7 @@ class FontField(Field):
         if len(self.data) == 2:
             name, size = self.data
             family = self.skin.font_family
-        elif len(self, self.data) == 3:
+        elif len(self.data) == 3:
             name, size, family = self.data
         self.value = get_font(family, name, size=int(self.scale * size))
         return self
@@ -245,24 +242,164 @@ class ComputedField(Field):
         return self
 
 
+class LoadedField(Field):
+    """
+    Field holding a value which has already been computed, e.g. copied from the field cache.
+    """
+    __slots__ = ()
+
+    def __init__(self, value):
+        self.default = None
+        self.data = None
+        self.value = value
+
+    def load(self):
+        return self
+
+    def close(self):
+        if isinstance(self.value, Image.Image):
+            self.value.close()
+
+
+def _copy_value(value):
+    """
+    Copy a loaded field value for use in a single render, so that layouts may freely modify it.
+    Immutable values (and fonts) are shared rather than copied.
+    """
+    if isinstance(value, Image.Image):
+        return value.copy()
+    elif isinstance(value, dict):
+        return {key: _copy_value(item) for key, item in value.items()}
+    elif isinstance(value, list):
+        return [_copy_value(item) for item in value]
+    elif isinstance(value, tuple):
+        return tuple(_copy_value(item) for item in value)
+    else:
+        return value
+
+
+# Per-process cache of loaded field values which do not depend on any overrides
+# Map of (skin class, card_id, base_skin_id, locale) -> {field name: (value, dependencies)}
+_loaded_fields = {}
+
+# Incremented whenever the field cache is cleared, see `Skin.fingerprint`
+_field_generation = 0
+
+
+def clear_field_cache():
+    """
+    Forget all cached field values, e.g. after the skin files have changed.
+    """
+    global _field_generation
+    _loaded_fields.clear()
+    _field_generation += 1
+
+
+class SkinFields(dict):
+    """
+    Map of field names to the loaded fields of a Skin.
+
+    Fields are loaded lazily, the first time they are read, and then kept for the lifetime of the skin.
+    While each field loads, the other fields it reads are recorded as its dependencies,
+    so that cached values may be reused whenever none of their dependencies are overridden.
+    Layouts may also reassign field values during a render, which invalidates the fields depending on them in the same way.
+    """
+    __slots__ = ('skin', 'cached', 'deps', 'values', '_reading')
+
+    def __init__(self, skin, cached):
+        super().__init__()
+        self.skin = skin
+
+        # Field cache entries for this skin, see `_loaded_fields`
+        self.cached = cached
+
+        # Map of field name -> names of all the fields its value was (transitively) computed from
+        self.deps = {}
+
+        # Map of field name -> value of the field as loaded, to detect values reassigned by the layout
+        self.values = {}
+
+        # Stack of the fields read by each field currently loading
+        self._reading = []
+
+    def __getitem__(self, name):
+        field = super().__getitem__(name)
+        if self._reading:
+            reads = self._reading[-1]
+            reads.add(name)
+            reads.update(self.deps[name])
+        return field
+
+    def _reusable(self, deps):
+        """
+        Whether a value computed from the given fields is the same for every skin sharing the field cache.
+        """
+        if not self.skin.overrides.keys().isdisjoint(deps):
+            return False
+        for dep in deps:
+            field = dict.get(self, dep, None)
+            if field is not None and field.value is not self.values[dep]:
+                return False
+        return True
+
+    def __missing__(self, name):
+        skin = self.skin
+        if name not in skin._plan:
+            raise KeyError(name)
+        overridden = skin.overrides.keys()
+
+        entry = self.cached.get(name, None)
+        if entry is not None and name not in overridden and self._reusable(entry[1]):
+            value, deps = entry
+            field = LoadedField(_copy_value(value))
+        else:
+            if name in self.deps:
+                raise ValueError(f"Skin field {name!r} depends on itself.")
+            # Mark the field as loading, in case it tries to read itself
+            self.deps[name] = None
+
+            field_cls, field_kwargs = skin._plan[name]
+            field = field_cls(**{
+                **field_kwargs,
+                **skin._env,
+                'data': skin.overwrites.get(name, None),
+                'skin': skin,
+            })
+            reads = set()
+            self._reading.append(reads)
+            try:
+                field.load()
+            finally:
+                self._reading.pop()
+                self.deps.pop(name)
+
+            deps = frozenset(reads)
+            if name not in overridden and self._reusable(deps):
+                self.cached[name] = (_copy_value(field.value), deps)
+
+        self.deps[name] = deps
+        self.values[name] = field.value
+        self[name] = field
+        return field
+
+
 class FieldDesc:
     def __init__(self, field_cls, default=None, **kwargs):
         self.field_cls = field_cls
         self.default = default
         self.kwargs = kwargs
 
-    def create(self, *args, **kwargs):
-        return self.field_cls(
-            *args,
-            **{'default': self.default, **self.kwargs, **kwargs}
-        )
-
 
 class Skin:
     # Field specifiers, describing the skin fields
     _fields = {
     }  # type: dict[str, FieldDesc]
 
+    # Load plan compiled from the field specifiers by `fielded`
+    # Map of field name -> (field class, field keyword arguments)
+    # Field dependencies, and so which fields are constant, are only discovered as fields load, see `SkinFields`
+    _plan = {}
+
     # Environment variables passed to every Field on initialisation
     # These may be copied and modified by individual skins
     _env = {
@@ -273,8 +410,11 @@ class Skin:
 
     def __init__(self, card_id, base_skin_id=None, locale=None, **kwargs):
         self.card_id = card_id
+        self.base_skin_id = base_skin_id
+        self.locale = locale
 
         self.base = AppSkin.get(base_skin_id, locale=locale).for_card(self.card_id)
+        self.overrides = kwargs
         self.overwrites = {**self.base, **kwargs}
         self.fields = None
 
@@ -285,13 +425,38 @@ class Skin:
         return self.overwrites
 
     def apply_overwrites(self, **kwargs):
+        self.overrides.update(kwargs)
         self.overwrites.update(kwargs)
 
-    def _preload_paths(self):
-        if 'PATH' not in self._env:
-            self._env['PATH'] = []
+    @property
+    def _cache_key(self):
+        return (type(self), self.card_id, self.base_skin_id, self.locale)
+
+    @property
+    def fingerprint(self):
+        """
+        Hashable identity of the values of this skin, for caching images drawn with it.
+        Skins with equal fingerprints have equal field values, until the skin files are reloaded.
+        """
+        overrides = repr(sorted(self.overrides.items(), key=lambda item: item[0]))
+        return (self._cache_key, overrides, _field_generation)
+
+    @classmethod
+    def preload(cls, card_id, base_skin_id=None, locale=None):
+        """
+        Load this skin without overrides into the per-process field cache,
+        so that later renders with the same card, base skin, and locale may reuse the loaded values.
+        """
+        skin = cls(card_id, base_skin_id=base_skin_id, locale=locale)
+        _loaded_fields.pop(skin._cache_key, None)
+        skin.load()
+        for name in cls._plan:
+            skin.fields[name]
+        skin.close()
 
-        self._env['PATH'].extend(self.base['PATH'])
+    def _preload_paths(self):
+        # Copy the class environment, so the asset paths of this skin don't leak into other instances
+        self._env = {**self._env, 'PATH': [*self._env.get('PATH', []), *self.base['PATH']]}
 
     def _preload(self):
         """
@@ -303,30 +468,26 @@ class Skin:
 
     def load(self):
         """
-        Load the current field values into a live Skin instance.
-        This preloads, initialises fields, loads fields, and executes final setup.
+        Prepare a live Skin instance for reading field values.
+        This preloads, and executes final setup. Fields are loaded as they are read.
         Should only be run during rendering process.
         """
         start = time.time()
         # last = start
 
         self._preload()
-        self.fields = {}
-        for name, field_desc in self._fields.items():
-            field = field_desc.create(
-                data=self.overwrites.get(name, None),
-                skin=self,
-                **self._env
-            ).load()
-            self.fields[name] = field
-
-            # now = time.time()
-            # Instrumentation debug
-            # logging.debug(f"{now - last:.6f} -- {name}: {field.value}")
-            # last = now
+
+        # Fields are loaded on first read
+        # Fields which are overridden, or depend on an overridden field, are loaded from scratch,
+        # and all other fields are copied from the field cache, once loaded
+        self.fields = SkinFields(self, _loaded_fields.setdefault(self._cache_key, {}))
+
         self._setup()
         end = time.time()
-        logger.debug(f"Skin loading took {end-start} seconds")
+        logger.debug(
+            f"Skin loading took {end-start} seconds, "
+            f"font cache: {font_cache_info()}, asset cache: {asset_cache_info()}"
+        )
         return self
 
     def _setup(self):
@@ -365,6 +526,12 @@ def fielded(cls):
             delattr(cls, attr)
     cls._fields = {**cls._fields, **_fields}
 
+    # Compile the load plan, so that loading only needs to add the environment and data
+    cls._plan = {
+        name: (desc.field_cls, {'default': desc.default, **desc.kwargs})
+        for name, desc in cls._fields.items()
+    }
+
     for field_name in _fields:
         setattr(cls, field_name, property(_field_property_wrapper(field_name)))
     return cls
@@ -0,0 +1,203 @@
+"""
+Compiled skin bundles.
+
+A bundle packs the skins directory into a single memory-mapped file,
+so that skins may be loaded (and shipped) without reading and parsing the individual skin files.
+
+File layout:
+    header (magic, index length) | JSON index | padding | data
+
+The index holds the parsed skin map and skin data files, the flattened card data of every skin,
+and a table giving the location in the data section of every file under the skins directory.
+PNG assets are stored pre-decoded, as raw pixel buffers along with their mode and size.
+
+Bundles are built from the skins directory with:
+    python -m <package>.bundle <output> [--locales en-GB,pt-BR,...]
+Skin data is compiled for every locale with a skin_<locale>.json file, unless the locales are given.
+"""
+import os
+import re
+import json
+import mmap
+import struct
+import logging
+from typing import Optional
+
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'SLSKIN\x00\x01'
+HEADER = struct.Struct('!8sQ')
+
+# Alignment of every buffer in the data section
+ALIGNMENT = 64
+
+# Image modes stored as-is, bilevel images are stored as L, and other modes are stored converted to RGBA
+RAW_MODES = ('RGBA', 'RGB', 'LA', 'L')
+
+# Localised skin data files
+LOCALE_FILE = re.compile(r'skin_(.+)\.json')
+
+
+def _align(offset):
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+def _skin_key(skin_path, locale):
+    return f"{skin_path}|{locale or ''}"
+
+
+def _card_key(skin_path, locale, card_id):
+    return f"{skin_path}|{locale or ''}|{card_id}"
+
+
+class SkinBundle:
+    """
+    Read-only view of a compiled skin bundle.
+    Asset paths are given relative to the skins directory.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, index_length = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{path!r} is not a skin bundle.")
+        self.index = json.loads(self._map[HEADER.size:HEADER.size + index_length])
+        self._data = memoryview(self._map)[_align(HEADER.size + index_length):]
+
+        self.skins_data = self.index['skins_data']
+        self.files = self.index['files']
+        self.images = self.index['images']
+        logger.info(
+            f"Loaded skin bundle {path!r} with {len(self.files)} files and {len(self.images)} decoded images."
+        )
+
+    def __contains__(self, path):
+        return path in self.images or path in self.files
+
+    def read(self, path) -> memoryview:
+        """
+        Raw contents of the given file.
+        """
+        offset, length = self.files[path]
+        return self._data[offset:offset + length]
+
+    def image(self, path) -> Image.Image:
+        """
+        Read-only image backed by the bundle, without decoding.
+        Copy the image before modifying it.
+        """
+        mode, size, offset, length = self.images[path]
+        return Image.frombuffer(mode, tuple(size), self._data[offset:offset + length], 'raw', mode, 0, 1)
+
+    def skin_data(self, skin_path, locale=None) -> Optional[dict]:
+        return self.index['skins'].get(_skin_key(skin_path, locale), None)
+
+    def card_data(self, skin_path, locale, card_id) -> Optional[dict]:
+        return self.index['cards'].get(_card_key(skin_path, locale, card_id), None)
+
+
+def build_bundle(output, skins_root, locales=None):
+    """
+    Compile the skins directory at `skins_root` into a bundle at `output`.
+    Skin and card data are compiled for every skin in the skin map, with no locale and each of `locales`.
+    By default, these are all the locales any skin has localised data for.
+    The bundle is written to a temporary file and moved into place, so running servers never see a partial bundle.
+    """
+    from .base.AppSkin import AppSkin, read_skins_data
+
+    index = {
+        'skins_data': read_skins_data(),
+        'skins': {},
+        'cards': {},
+        'files': {},
+        'images': {},
+    }
+    buffers = []
+    offset = 0
+    found_locales = set()
+
+    def add_buffer(data):
+        nonlocal offset
+        start = _align(offset)
+        buffers.append((start, data))
+        offset = start + len(data)
+        return start, len(data)
+
+    for root, _, files in os.walk(skins_root):
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            key = os.path.relpath(path, skins_root)
+            if (match := LOCALE_FILE.fullmatch(name)):
+                found_locales.add(match[1])
+            if name.lower().endswith('.png'):
+                with Image.open(path) as image:
+                    if image.mode == '1':
+                        # Keep the image usable as a mask, RGBA would mask with its opaque alpha band instead
+                        image = image.convert('L')
+                    elif image.mode not in RAW_MODES:
+                        image = image.convert('RGBA')
+                    index['images'][key] = (image.mode, image.size, *add_buffer(image.tobytes()))
+            else:
+                with open(path, 'rb') as f:
+                    index['files'][key] = add_buffer(f.read())
+
+    if locales is None:
+        locales = sorted(found_locales)
+
+    # Card identifiers are the property sections of every skin, other than the common properties
+    card_ids = set()
+    for locale in (None, *locales):
+        for skin_id in index['skins_data']['skin_map']:
+            appskin = AppSkin.get(skin_id, locale=locale)
+            index['skins'][_skin_key(appskin.skin_path, locale)] = appskin.skin_data
+            card_ids.update(appskin.skin_data.get('properties', {}).keys())
+    card_ids.discard('common')
+
+    for locale in (None, *locales):
+        for skin_id in index['skins_data']['skin_map']:
+            appskin = AppSkin.get(skin_id, locale=locale)
+            for card_id in card_ids:
+                index['cards'][_card_key(appskin.skin_path, locale, card_id)] = appskin.for_card(card_id)
+
+    index_data = json.dumps(index).encode()
+    data_start = _align(HEADER.size + len(index_data))
+
+    tmp_path = f"{output}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, len(index_data)))
+        f.write(index_data)
+        for start, data in buffers:
+            f.seek(data_start + start)
+            f.write(data)
+    os.replace(tmp_path, output)
+    logger.info(
+        f"Built skin bundle {output!r} with {len(index['files'])} files, {len(index['images'])} images, "
+        f"and {len(index['cards'])} compiled cards."
+    )
+
+
+if __name__ == '__main__':
+    import argparse
+    from . import utils
+    from .base.AppSkin import AppSkin
+
+    parser = argparse.ArgumentParser(description="Compile the skins directory into a skin bundle.")
+    parser.add_argument('output', help="Path to write the bundle to.")
+    parser.add_argument(
+        '--locales', default=None,
+        help="Comma separated list of locales to compile skin data for, all localised skin data by default."
+    )
+    args = parser.parse_args()
+
+    # Always build from the skin files, not from a configured bundle
+    utils.skin_bundle = None
+    AppSkin.reload()
+    build_bundle(
+        args.output,
+        utils.__skins_location__,
+        [locale.strip() for locale in args.locales.split(',') if locale.strip()] if args.locales is not None else None
+    )
@@ -4,5 +4,5 @@ from .goals import WeeklyGoalCard, MonthlyGoalCard
 from .monthly import MonthlyStatsCard
 from .weekly import WeeklyStatsCard
 from .tasklist import TasklistCard
-from .leaderboard import LeaderboardCard
+from .leaderboard import LeaderboardCard, LeaderboardPagesCard
 from .timer import BreakTimerCard, FocusTimerCard
@@ -1,7 +1,6 @@
 import math
 import logging
 import datetime
-from io import BytesIO
 from PIL import Image, ImageDraw, ImageOps, ImageColor
 
 from babel.translator import LocalBabel
@@ -795,13 +794,6 @@ class _GoalCard(Card):
         kwargs['avatar'] = await avatar_manager().get_avatar(*kwargs['avatar'], 256)
         return await super().card_route(runner, args, kwargs)
 
-    @classmethod
-    def _execute(cls, *args, **kwargs):
-        with BytesIO(kwargs['avatar']) as image_data:
-            with Image.open(image_data).convert('RGBA') as avatar_image:
-                kwargs['avatar'] = avatar_image
-                return super()._execute(*args, **kwargs)
-
 
 class WeeklyGoalCard(_GoalCard):
     route = "weekly_goal_card"
@@ -3,9 +3,12 @@ import logging
 from io import BytesIO
 from PIL import Image, ImageDraw
 
+from cachetools import LRUCache
+
+from meta import conf
 from babel.translator import LocalBabel
 
-from ..utils import getsize
+from ..utils import getsize, open_asset, image_nbytes, cache_put
 from ..base import Card, Layout, fielded, Skin, FieldDesc, CardMode
 from ..base.Avatars import avatar_manager
 from ..base.Skin import (
@@ -17,6 +20,12 @@ logger = logging.getLogger(__name__)
 babel = LocalBabel('leaderboard-gui')
 _p, _np = babel._p, babel._np
 
+# Maximum total size of the cached leaderboard entry rows in each worker, in megabytes
+ROW_CACHE_SIZE = conf.gui.getint('leaderboard_row_cache_size', fallback=32)
+
+# Map of (skin fingerprint, position, name, time, drawn avatar key, highlight) -> drawn entry row
+_row_cache = LRUCache(ROW_CACHE_SIZE * 1024 * 1024, getsizeof=image_nbytes)
+
 
 class LeaderboardEntry:
     __slots__ = (
@@ -42,15 +51,8 @@ class LeaderboardEntry:
 
     async def get_avatar(self):
         if not self.image:
-            self.image = await avatar_manager().get_avatar(
-                *self.avatar_key,
-                size=512 if self.position in (1, 2, 3) else 256
-            )
-
-    def convert_avatar(self):
-        if self.image:
-            with BytesIO(self.image) as data:
-                self.image = Image.open(data).convert('RGBA')
+            size = 512 if self.position in (1, 2, 3) else 256
+            self.image = await avatar_manager().get_avatar(*self.avatar_key, size=size)
 
 
 @fielded
@@ -213,7 +215,7 @@ class LeaderboardSkin(Skin):
 
 
 class LeaderboardPage(Layout):
-    def __init__(self, skin, server_name, entries, highlight=None, **kwargs):
+    def __init__(self, skin, server_name, entries, highlight=None, header=None, **kwargs):
         self.skin = skin
 
         self.server_name = server_name
@@ -221,6 +223,11 @@ class LeaderboardPage(Layout):
         self.highlight = highlight
         self.first_page = any(entry.position in (1, 2, 3) for entry in entries)
 
+        # Header image, may be shared between pages
+        self.header = header
+
+        self.skin_fingerprint = skin.fingerprint
+
         self.image = None
 
     def draw(self) -> Image:
@@ -232,14 +239,14 @@ class LeaderboardPage(Layout):
 
     def _draw_first_page(self) -> Image:
         # Collect background
-        image = Image.open(self.skin.first_bg_path)
+        image = open_asset(self.skin.first_bg_path)
         draw = ImageDraw.Draw(image)
 
         xpos, ypos = 0, 0
 
         # Draw the header text
         ypos += self.skin.header_text_pre_gap
-        header = self._draw_header_text()
+        header = self._get_header()
         image.alpha_composite(
             header,
             (xpos + (image.width // 2 - header.width // 2),
@@ -382,10 +389,10 @@ class LeaderboardPage(Layout):
 
     def _draw_other_page(self) -> Image:
         # Collect background
-        image = Image.open(self.skin.other_bg_path).convert('RGBA')
+        image = open_asset(self.skin.other_bg_path, 'RGBA')
 
         # Draw header onto background
-        header = self._draw_header_text()
+        header = self._get_header()
         image.alpha_composite(
             header,
             (
@@ -415,15 +422,28 @@ class LeaderboardPage(Layout):
         return image
 
     def _draw_entry(self, entry, highlight=False) -> Image:
+        """
+        Retrieve the row image for the given entry, drawing it if it is not cached.
+        The returned image is shared, and must not be modified.
+        """
+        key = (
+            self.skin_fingerprint,
+            entry.position, entry.name, entry.time, entry.image.key,
+            bool(highlight)
+        )
+        if (image := _row_cache.get(key, None)) is None:
+            image = self._render_entry(entry, highlight=highlight)
+            cache_put(_row_cache, key, image)
+        return image
+
+    def _render_entry(self, entry, highlight=False) -> Image:
         # Get the appropriate background
         image = (self.skin.entry_bg if not highlight else self.skin.entry_highlight_bg).copy()
         draw = ImageDraw.Draw(image)
         ypos = image.height // 2
 
         # Mask the avatar, if it exists
-        avatar = entry.image
-        avatar.thumbnail((187, 187))
-        avatar.paste((0, 0, 0, 0), mask=self.skin.entry_mask)
+        avatar = entry.image.prepared(self.skin, 'entry_mask')
 
         # Paste avatar onto image
         image.alpha_composite(avatar, (0, 0))
@@ -470,13 +490,9 @@ class LeaderboardPage(Layout):
         elif level == 3:
             image = self.skin.third_avatar_bg
 
-        # Retrieve and mask avatar
-        avatar = entry.image
-        avatar.paste((0, 0, 0, 0), mask=self.skin.first_avatar_mask)
-
-        # Resize for background with gap
+        # Retrieve and mask avatar, resized for background with gap
         dest_width = image.width - 2 * self.skin.first_avatar_gap
-        avatar.thumbnail((dest_width, dest_width))
+        avatar = entry.image.prepared(self.skin, 'first_avatar_mask', size=(dest_width, dest_width))
 
         # Paste on the background
         image.alpha_composite(
@@ -488,6 +504,11 @@ class LeaderboardPage(Layout):
 
         return image
 
+    def _get_header(self) -> Image:
+        if self.header is None:
+            self.header = self._draw_header_text()
+        return self.header
+
     def _draw_header_text(self) -> Image:
         text_name = self.skin.subheader_server_text
         text_value = self.server_name
@@ -543,6 +564,48 @@ class LeaderboardPage(Layout):
         return image
 
 
+class LeaderboardPages(Layout):
+    """
+    Draws several leaderboard pages from a single loaded skin, sharing the header between the pages.
+    """
+    def __init__(self, skin, server_name, pages, highlight=None, **kwargs):
+        self.skin = skin
+
+        self.server_name = server_name
+        self.pages = pages
+        self.highlight = highlight
+
+        self.images = []
+
+    def _execute_draw(self):
+        image_data = []
+        for image in self.iter_pages():
+            with BytesIO() as data:
+                image.save(data, format='PNG', compress_type=3, compress_level=1)
+                image_data.append(data.getvalue())
+            image.close()
+        return image_data
+
+    def iter_pages(self):
+        """
+        Draw the pages one at a time, as they are requested.
+        The caller is responsible for closing each page image.
+        """
+        header = None
+        for entries in self.pages:
+            page = LeaderboardPage(self.skin, self.server_name, entries, highlight=self.highlight, header=header)
+            yield page.draw()
+            header = page.header
+
+    def draw(self):
+        self.images = list(self.iter_pages())
+        return self.images
+
+    def close(self):
+        for image in self.images:
+            image.close()
+
+
 class LeaderboardCard(Card):
     route = 'leaderboard_card'
     card_id = 'leaderboard'
@@ -555,6 +618,9 @@ class LeaderboardCard(Card):
         "Leaderboard"
     )
 
+    # Identical requests are common when paging back and forth
+    cache_ttl = 300
+
     @classmethod
     async def card_route(cls, runner, args, kwargs):
         entries = [LeaderboardEntry(*entry) for entry in kwargs['entries']]
@@ -564,12 +630,6 @@ class LeaderboardCard(Card):
         kwargs['entries'] = entries
         return await super().card_route(runner, args, kwargs)
 
-    @classmethod
-    def _execute(cls, *args, **kwargs):
-        for entry in kwargs['entries']:
-            entry.convert_avatar()
-        return super()._execute(*args, **kwargs)
-
     @classmethod
     async def sample_args(cls, ctx, **kwargs):
         from ..utils import get_avatar_key
@@ -594,3 +654,56 @@ class LeaderboardCard(Card):
             ],
             'highlight': 4
         }
+
+
+class LeaderboardPagesCard(LeaderboardCard):
+    """
+    Renders every page of a leaderboard, or a range of its pages, in a single request.
+
+    Accepts the full ranked entry list, split into pages of `page_size` entries,
+    and returns the list of rendered pages, from page `pages[0]` (inclusive) to `pages[1]` (exclusive).
+    Avatars are only fetched for the entries on the requested pages.
+    """
+    route = 'leaderboard_pages'
+
+    layout = LeaderboardPages
+
+    @classmethod
+    async def card_route(cls, runner, args, kwargs):
+        entries = kwargs.pop('entries')
+        page_size = kwargs.pop('page_size', 10)
+        start, stop = kwargs.pop('pages', None) or (0, None)
+
+        pages = [
+            [LeaderboardEntry(*entry) for entry in entries[i:i+page_size]]
+            for i in range(0, len(entries), page_size)
+        ][start:stop]
+        await asyncio.gather(
+            *(entry.get_avatar() for page in pages for entry in page)
+        )
+        kwargs['pages'] = pages
+        # Skip the single page entry handling of LeaderboardCard
+        return await super(LeaderboardCard, cls).card_route(runner, args, kwargs)
+
+    @classmethod
+    async def generate_sample(cls, ctx=None, **kwargs):
+        from ..utils import image_as_file
+
+        sample_kwargs = await cls.sample_args(ctx)
+        cards = await cls.request(**{**sample_kwargs, **kwargs})
+        return image_as_file(cards[0], "sample.png")
+
+    @classmethod
+    async def sample_args(cls, ctx, **kwargs):
+        sample = await super().sample_args(ctx, **kwargs)
+        entries = sample['entries']
+        names = [entry[3] for entry in entries[1:]]
+        # Extend the sample leaderboard over three pages, and render the first two
+        for position in range(len(entries) + 1, 26):
+            time = 257274 * (26 - position) // 16
+            entries.append((position - 1, position, time, names[position % len(names)], (0, None)))
+        return {
+            **sample,
+            'page_size': 10,
+            'pages': (0, 2),
+        }
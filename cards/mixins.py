@@ -47,8 +47,7 @@ class MiniProfileLayout:
             frame.thumbnail((image.height, image.height))
 
         # Draw avatar
-        avatar = self.data_avatar
-        avatar.paste((0, 0, 0, 0), mask=self.skin.mini_profile_avatar_mask)
+        avatar = self.data_avatar.prepared(self.skin, 'mini_profile_avatar_mask')
         avatar_image = Image.new('RGBA', frame.size)
         avatar_image.paste(
             avatar,
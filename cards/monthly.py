@@ -900,6 +900,9 @@ class MonthlyStatsCard(Card):
         "Monthly Stats"
     )
 
+    # These are frequently re-requested unchanged within a few minutes
+    cache_ttl = 300
+
     @classmethod
     async def sample_args(cls, ctx, **kwargs):
         import random
@@ -1,10 +1,9 @@
 import logging
-from io import BytesIO
 from PIL import Image, ImageDraw
 
 from babel.translator import LocalBabel
 
-from ..utils import get_avatar_key, font_height
+from ..utils import get_avatar_key, font_height, open_asset
 from ..base import Card, Layout, fielded, Skin, FieldDesc, CardMode
 from ..base.Avatars import avatar_manager
 from ..base.Skin import (
@@ -274,10 +273,8 @@ class ProfileLayout(Layout):
         position = 0
 
         # Draw avatar
-        _avatar = self.data_avatar
-
         # Mask the avatar image to the desired shape
-        _avatar.paste((0, 0, 0, 0), mask=self.skin.avatar_mask)
+        _avatar = self.data_avatar.prepared(self.skin, 'avatar_mask')
 
         # Place the image on a larger canvas
         avatar_image = Image.new('RGBA', self.skin.avatar_outline.size)
@@ -480,7 +477,7 @@ class ProfileLayout(Layout):
                 self.skin.achievement_active_path if (i in self.data_achievements) else self.skin.achievement_inactive_path,
                 i + 1
             )
-            icon = Image.open(icon_path).convert('RGBA')
+            icon = open_asset(icon_path, 'RGBA')
 
             # Offset to top left corner of pasted icon
             xoffset = (self.skin.achievement_icon_size[0] - icon.width) // 2
@@ -613,13 +610,6 @@ class ProfileCard(Card):
         kwargs['avatar'] = await avatar_manager().get_avatar(*kwargs['avatar'], 256)
         return await super().card_route(runner, args, kwargs)
 
-    @classmethod
-    def _execute(cls, *args, **kwargs):
-        with BytesIO(kwargs['avatar']) as image_data:
-            with Image.open(image_data).convert('RGBA') as avatar_image:
-                kwargs['avatar'] = avatar_image
-                return super()._execute(*args, **kwargs)
-
     @classmethod
     async def sample_args(cls, ctx, **kwargs):
         return {
@@ -1,5 +1,4 @@
 from io import BytesIO
-import pickle
 
 from PIL import Image, ImageDraw
 
@@ -114,7 +113,7 @@ class TasklistLayout(Layout, MiniProfileLayout):
                 image.save(data, format='PNG')
                 data.seek(0)
                 image_data.append(data.getvalue())
-        return pickle.dumps(image_data)
+        return image_data
 
     def draw(self):
         self.images = []
@@ -335,23 +334,11 @@ class TasklistCard(Card):
 
     display_name = "Tasklist"
 
-    @classmethod
-    async def request(cls, *args, **kwargs):
-        data = await super().request(*args, **kwargs)
-        return pickle.loads(data)
-
     @classmethod
     async def card_route(cls, runner, args, kwargs):
         kwargs['avatar'] = await avatar_manager().get_avatar(*kwargs['avatar'], 256)
         return await super().card_route(runner, args, kwargs)
 
-    @classmethod
-    def _execute(cls, *args, **kwargs):
-        with BytesIO(kwargs['avatar']) as image_data:
-            with Image.open(image_data).convert('RGBA') as avatar_image:
-                kwargs['avatar'] = avatar_image
-                return super()._execute(*args, **kwargs)
-
     @classmethod
     async def generate_sample(cls, ctx=None, **kwargs):
         from ..utils import image_as_file
@@ -1,15 +1,16 @@
 import math
 import logging
-from io import BytesIO
 from PIL import Image, ImageDraw, ImageOps
+from cachetools import LRUCache
 
+from meta import conf
 from babel.translator import LocalBabel
 
-from ..utils import font_height, getsize
+from ..utils import font_height, getsize, image_nbytes, cache_put, RenderPriority
 from ..base import Card, Layout, fielded, Skin
 from ..base.Avatars import avatar_manager
 from ..base.Skin import (
-    AssetField, LazyStringField, NumberField,
+    AssetField, RGBAAssetField, LazyStringField, NumberField,
     FontField, ColourField, PointField, ComputedField, RawField
 )
 
@@ -17,6 +18,12 @@ logger = logging.getLogger(__name__)
 babel = LocalBabel('timer-gui')
 _p = babel._p
 
+# Maximum total size of the cached static timer layers in each worker, in megabytes
+BASE_CACHE_SIZE = conf.gui.getint('timer_base_cache_size', fallback=64)
+
+# Map of (skin fingerprint, name, displayed users) -> static layers of the timer card
+_base_cache = LRUCache(BASE_CACHE_SIZE * 1024 * 1024, getsizeof=image_nbytes)
+
 
 @fielded
 class _TimerSkin(Skin):
@@ -55,7 +62,7 @@ class _TimerSkin(Skin):
 
     # Members
     user_bg: AssetField = "timer/break_user.png"
-    user_mask: AssetField = "timer/avatar_mask.png"
+    user_mask: RGBAAssetField = "timer/avatar_mask.png"
 
     time_font: FontField = ('Black', 26)
     time_colour: ColourField = '#FFFFFF'
@@ -123,29 +130,12 @@ class TimerLayout(Layout):
             return "{:02}:{:02}".format(int(time // 60), int(time % 60))
 
     def draw(self):
-        image = self.skin.background
+        image = self._get_base()
         draw = ImageDraw.Draw(image)
 
-        # Draw header
-        text = self.data_name
-        length = self.skin.header_font.getlength(text)
-        draw.text(
-            (image.width // 2, self.skin.header_field_height // 2),
-            text,
-            fill=self.skin.main_colour,
-            font=self.skin.header_font,
-            anchor='mm'
-        )
-
         # Draw timer
-        timer_image = self._draw_progress_bar(self.data_amount)
-        ypos = timer_y = (
-            self.skin.header_field_height
-            + (image.height - self.skin.header_field_height - timer_image.height) // 2
-            - self.skin.progress_end.height // 2
-        )
-        xpos = timer_x = image.width - self.skin.inner_margin - timer_image.width
-
+        (xpos, ypos), _ = self._timer_box(image)
+        timer_image = self._draw_progress_bar(self.data_amount, background=False)
         image.alpha_composite(
             timer_image,
             (xpos, ypos)
@@ -183,13 +173,73 @@ class TimerLayout(Layout):
             font=self.skin.stage_font,
             anchor='ls'
         )
+        return image
+
+    def _timer_box(self, image):
+        """
+        Position and size of the progress ring on the card.
+        """
+        size = (
+            self.skin.timer_bg.width + self.skin.progress_end.width,
+            self.skin.timer_bg.height + self.skin.progress_end.height
+        )
+        position = (
+            image.width - self.skin.inner_margin - size[0],
+            self.skin.header_field_height
+            + (image.height - self.skin.header_field_height - size[1]) // 2
+            - self.skin.progress_end.height // 2
+        )
+        return position, size
+
+    def _get_base(self):
+        """
+        Copy of the static layers of the card, drawing them if they are not cached.
+        Between refreshes of a timer these only change when members join or leave,
+        or when a member's displayed time passes a minute.
+        """
+        key = (
+            self.skin.fingerprint,
+            self.data_name,
+            tuple((avatar.key, self.format_time(time), tag) for avatar, time, tag in self.data_users[:25])
+        )
+        if (image := _base_cache.get(key, None)) is None:
+            image = self._draw_base()
+            if not cache_put(_base_cache, key, image):
+                return image
+        return image.copy()
+
+    def _draw_base(self):
+        """
+        Draw the static layers of the card: the background, header, progress ring background, user grid, and footer.
+        """
+        image = self.skin.background.copy()
+        draw = ImageDraw.Draw(image)
+
+        # Draw header
+        text = self.data_name
+        draw.text(
+            (image.width // 2, self.skin.header_field_height // 2),
+            text,
+            fill=self.skin.main_colour,
+            font=self.skin.header_font,
+            anchor='mm'
+        )
+
+        # Draw timer background
+        (timer_x, timer_y), timer_size = self._timer_box(image)
+        image.alpha_composite(
+            self.skin.timer_bg,
+            (timer_x + self.skin.progress_end.width // 2,
+             timer_y + self.skin.progress_end.height // 2)
+        )
+        stage_height = font_height(self.skin.stage_font)
 
         # Draw user grid
         if self.data_users:
             grid_image = self.draw_user_grid()
 
             # ypos = self.skin.header_field_height + (image.height - self.skin.header_field_height - grid_image.height) // 2
-            ypos = timer_y + (timer_image.height - grid_image.height) // 2 - stage_height // 2
+            ypos = timer_y + (timer_size[1] - grid_image.height) // 2 - stage_height // 2
             xpos = (
                 self.skin.inner_margin
                 + (timer_x - self.skin.inner_sep - self.skin.inner_margin) // 2
@@ -252,14 +302,13 @@ class TimerLayout(Layout):
         image.alpha_composite(self.skin.user_bg)
 
         avatar, time, tag = user
-        avatar = avatar
         timestr = self.format_time(time, hours=True)
 
-        # Mask avatar
-        avatar.paste((0, 0, 0, 0), mask=self.skin.user_mask.convert('RGBA'))
-
-        # Resize avatar
-        avatar.thumbnail((self.skin.user_bg.height - 10, self.skin.user_bg.height - 10))
+        # Mask and resize avatar
+        avatar = avatar.prepared(
+            self.skin, 'user_mask',
+            size=(self.skin.user_bg.height - 10, self.skin.user_bg.height - 10)
+        )
 
         image.alpha_composite(
             avatar,
@@ -288,7 +337,11 @@ class TimerLayout(Layout):
             )
         return image
 
-    def _draw_progress_bar(self, amount):
+    def _draw_progress_bar(self, amount, background=True):
+        """
+        Draw the progress ring filled to the given amount.
+        The ring background may be left out, when it is already drawn beneath.
+        """
         amount = min(amount, 1)
         amount = max(amount, 0)
         bg = self.skin.timer_bg
@@ -368,11 +421,12 @@ class TimerLayout(Layout):
             size=(bg.width + self.skin.progress_end.width,
                   bg.height + self.skin.progress_end.height)
         )
-        image.alpha_composite(
-            bg,
-            (self.skin.progress_end.width // 2,
-             self.skin.progress_end.height // 2)
-        )
+        if background:
+            image.alpha_composite(
+                bg,
+                (self.skin.progress_end.width // 2,
+                 self.skin.progress_end.height // 2)
+            )
         image.alpha_composite(
             canvas,
             (self.skin.progress_end.width // 2,
@@ -393,6 +447,21 @@ class TimerLayout(Layout):
 class _TimerCard(Card):
     layout = TimerLayout
 
+    # Timer cards are refreshed periodically, so interactive requests should be rendered first
+    priority = RenderPriority.PERIODIC
+
+    # Refreshes only repeat within the same 5 second countdown step
+    cache_ttl = 10
+
+    @classmethod
+    async def request(cls, *args, **kwargs):
+        # The countdown is only displayed in 5 second steps.
+        # Quantising the remaining time here makes refreshes of the same timer identical,
+        # so the rendering server can coalesce them.
+        if kwargs.get('remaining', None) is not None:
+            kwargs['remaining'] = 5 * math.ceil(kwargs['remaining'] / 5)
+        return await super().request(*args, **kwargs)
+
     @classmethod
     async def card_route(cls, runner, args, kwargs):
         if kwargs['users']:
@@ -402,19 +471,6 @@ class _TimerCard(Card):
 
         return await super().card_route(runner, args, kwargs)
 
-    @classmethod
-    def _execute(cls, *args, **kwargs):
-        if kwargs['users']:
-            avatar_data, times, tags = zip(*kwargs['users'])
-            avatars = []
-            for datum in avatar_data:
-                with BytesIO(datum) as buffer:
-                    buffer.seek(0)
-                    avatars.append(Image.open(buffer).convert('RGBA'))
-            kwargs['users'] = tuple(zip(avatars, times, tags))
-
-        return super()._execute(*args, **kwargs)
-
 
 class FocusTimerCard(_TimerCard):
     route = 'focus_timer_card'
@@ -8,7 +8,7 @@ from datetime import timedelta, datetime, timezone
 from babel.translator import LocalBabel
 from babel.utils import local_month
 
-from ..utils import resolve_asset_path, font_height, getsize
+from ..utils import resolve_asset_path, font_height, getsize, open_asset
 from ..base import Card, Layout, fielded, Skin, CardMode
 from ..base.Skin import (
     AssetField, RGBAAssetField, AssetPathField, BlobField, StringField, NumberField, PointField, RawField,
@@ -189,12 +189,13 @@ class WeeklyStatsSkin(Skin):
 
     btm_emoji_path: StringField = "weekly/emojis"
     btm_emojis: ComputedField = lambda skin: {
-        state: Image.open(
+        state: open_asset(
             resolve_asset_path(
                 skin._env['PATH'],
                 os.path.join(skin.btm_emoji_path, f"{state}.png")
-            )
-        ).convert('RGBA')
+            ),
+            'RGBA'
+        )
         for state in ('very_happy', 'happy', 'neutral', 'sad', 'shocked')
     }
 
@@ -839,6 +840,9 @@ class WeeklyStatsCard(Card):
         "Weekly Stats"
     )
 
+    # These are frequently re-requested unchanged within a few minutes
+    cache_ttl = 300
+
     @classmethod
     async def sample_args(cls, ctx, **kwargs):
         import random
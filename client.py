@@ -1,16 +1,16 @@
 from typing import Optional
 import asyncio
-import pickle
 import time
 import logging
 import datetime as dt
-from contextlib import asynccontextmanager
+from cachetools import LRUCache
 
 from meta import conf
 from meta.logger import set_logging_context, with_log_ctx
 from utils.lib import utc_now
 
-from .utils import RequestState, short_uuid
+from .utils import RequestState, RenderPriority, short_uuid, request_key
+from .protocol import read_response, write_request
 from .errors import (
     RenderingException,
     ConnectionFailure,
@@ -26,6 +26,77 @@ socket_path = conf.gui.get('socket_path')
 # TODO: Catch RenderingException from the usual places with a custom error.
 
 
+class RenderConnection:
+    """
+    A single persistent connection to the rendering server.
+
+    Requests are written as tagged frames, and a reader task dispatches each response frame
+    to the future waiting on its request id, so many requests may be in flight at once.
+    """
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+
+        # Map of request ids to futures awaiting the response
+        self.pending = {}
+
+        self._reader_task = asyncio.create_task(self._read_loop(), name="GUI connection reader")
+
+    @property
+    def closed(self):
+        return self.writer.is_closing() or self._reader_task.done()
+
+    async def _read_loop(self):
+        try:
+            while True:
+                response = await read_response(self.reader)
+                future = self.pending.pop(response.rqid, None)
+                if future is not None and not future.done():
+                    future.set_result(response)
+                else:
+                    logger.debug(
+                        f"Discarding rendering response for unknown or cancelled request {response.rqid!r}."
+                    )
+        except asyncio.CancelledError:
+            raise
+        except (asyncio.IncompleteReadError, ConnectionError):
+            logger.info("Rendering connection was closed by the server.")
+        except Exception:
+            logger.exception("Unexpected exception reading from the rendering connection. Closing connection.")
+        finally:
+            self._fail_pending()
+            if not self.writer.is_closing():
+                self.writer.close()
+
+    def _fail_pending(self):
+        pending, self.pending = self.pending, {}
+        for future in pending.values():
+            if not future.done():
+                future.set_exception(ConnectionResetError("Rendering connection closed."))
+
+    async def send(self, rqid, route, args, kwargs, priority=RenderPriority.NORMAL, deadline=None, etag=None):
+        """
+        Send a rendering request over this connection and wait for the matching response.
+        """
+        future = asyncio.get_running_loop().create_future()
+        self.pending[rqid] = future
+        try:
+            write_request(self.writer, rqid, route, args, kwargs, priority=priority, deadline=deadline, etag=etag)
+            await self.writer.drain()
+            return await future
+        finally:
+            self.pending.pop(rqid, None)
+
+    async def close(self):
+        self._reader_task.cancel()
+        if not self.writer.is_closing():
+            self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+
+
 class GUIclient:
     retry_base = 2
     retry_delay = 5
@@ -38,7 +109,12 @@ class GUIclient:
     # Avoids clogging the pipeline with waiting (and usually expired) requests
     request_expiry = 30
 
-    max_concurrent = 5
+    # Maximum number of persistent connections to hold open to the rendering server
+    # Requests are multiplexed over these, so this does not limit the number of requests in flight
+    pool_size = 2
+
+    # Maximum total size of recent results to keep for conditional requests, in bytes
+    cache_size = 64 * 1024 * 1024
 
     def __init__(self, socket_path: str):
         self.socket_path = socket_path
@@ -50,8 +126,12 @@ class GUIclient:
         # Connection lock ensures only one task is trying to get a new connection at a time
         self._connection_lock = asyncio.Lock()
 
-        # Limit the number of allowed connections
-        self._connection_sem = asyncio.Semaphore(self.max_concurrent)
+        # Pool of live persistent connections
+        self._connections: list[RenderConnection] = []
+
+        # Cache of recent results, as request key -> (etag, image data)
+        # Requests for cached keys send the etag, so the server may skip sending unchanged images
+        self._cache = LRUCache(self.cache_size, getsizeof=_result_size)
 
         # Internal cache of rendering request tasks
         # This is for easier introspection
@@ -62,79 +142,93 @@ class GUIclient:
         return min(self.max_delay, self.retry_delay + self.retry_base ** fail_count)
 
     async def _new_connection(self):
-        async with self._connection_lock:
-            while True:
-                now = utc_now()
-                if self.retry_next and self.retry_next > now:
-                    await asyncio.sleep((self.retry_next - now).total_seconds())
-                try:
-                    connection = await asyncio.wait_for(
-                        asyncio.open_unix_connection(path=self.socket_path),
-                        timeout=self.connection_timeout
-                    )
-                    if self.failures > 0:
-                        logger.info(
-                            f"Rendering connection succeeded after {self.failures} failures."
-                        )
-                    self.failures = 0
-                    self.retry_next = None
-                    return connection
-                except asyncio.CancelledError:
-                    raise
-                except asyncio.TimeoutError:
-                    self.failures += 1
-                    self.total_failures += 1
-                    delay = self.delay(self.failures)
-                    self.retry_next = utc_now() + dt.timedelta(seconds=delay)
-                    logger.warning(
-                        f"Connection to the rendering server timed out! Next retry after {delay} seconds"
-                    )
-                except (ConnectionRefusedError, ConnectionError, ConnectionResetError):
-                    self.failures += 1
-                    self.total_failures += 1
-                    delay = self.delay(self.failures)
-                    self.retry_next = utc_now() + dt.timedelta(seconds=delay)
-                    logger.warning(
-                        f"Connection to the rendering server failed! Next retry after {delay} seconds",
-                        exc_info=True,
-                    )
-                except Exception:
-                    self.failures += 1
-                    self.total_failures += 1
-                    delay = self.delay(self.failures)
-                    self.retry_next = utc_now() + dt.timedelta(seconds=delay)
-                    logger.exception(
-                        "Unexpected exception encountered connecting to the rendering server! "
-                        f"Skipping connection, setting retry to {delay} seconds.",
-                        exc_info=True,
+        """
+        Open a new connection to the rendering server, retrying with backoff on failure.
+        Should be called with the connection lock held.
+        """
+        while True:
+            now = utc_now()
+            if self.retry_next and self.retry_next > now:
+                await asyncio.sleep((self.retry_next - now).total_seconds())
+            try:
+                connection = await asyncio.wait_for(
+                    asyncio.open_unix_connection(path=self.socket_path),
+                    timeout=self.connection_timeout
+                )
+                if self.failures > 0:
+                    logger.info(
+                        f"Rendering connection succeeded after {self.failures} failures."
                     )
-                    raise
-
-    @asynccontextmanager
-    async def connection(self):
+                self.failures = 0
+                self.retry_next = None
+                return connection
+            except asyncio.CancelledError:
+                raise
+            except asyncio.TimeoutError:
+                self.failures += 1
+                self.total_failures += 1
+                delay = self.delay(self.failures)
+                self.retry_next = utc_now() + dt.timedelta(seconds=delay)
+                logger.warning(
+                    f"Connection to the rendering server timed out! Next retry after {delay} seconds"
+                )
+            except (ConnectionRefusedError, ConnectionError, ConnectionResetError):
+                self.failures += 1
+                self.total_failures += 1
+                delay = self.delay(self.failures)
+                self.retry_next = utc_now() + dt.timedelta(seconds=delay)
+                logger.warning(
+                    f"Connection to the rendering server failed! Next retry after {delay} seconds",
+                    exc_info=True,
+                )
+            except Exception:
+                self.failures += 1
+                self.total_failures += 1
+                delay = self.delay(self.failures)
+                self.retry_next = utc_now() + dt.timedelta(seconds=delay)
+                logger.exception(
+                    "Unexpected exception encountered connecting to the rendering server! "
+                    f"Skipping connection, setting retry to {delay} seconds.",
+                    exc_info=True,
+                )
+                raise
+
+    def _should_grow(self):
+        self._connections = [conn for conn in self._connections if not conn.closed]
+        return len(self._connections) < self.pool_size and all(conn.pending for conn in self._connections)
+
+    async def connection(self) -> RenderConnection:
+        """
+        Get a persistent connection to send a request over.
+        Opens a new connection if every pooled connection is busy and the pool is not full,
+        otherwise returns the least loaded connection.
+        """
         set_logging_context(action="GUI connect")
-        if self._connection_sem.locked():
-            logger.debug("GUI render request pool full. Queuing request.")
-        async with self._connection_sem:
-            logger.debug("Acquired connection semaphore, requesting connection.")
-            connection = await self._new_connection()
-            logger.debug("Acquired connection.")
-
-            try:
-                _, writer = connection
-                yield connection
-            finally:
-                logger.debug("Closing connection")
-                if not writer.is_closing():
-                    writer.close()
-                    await writer.wait_closed()
+        if self._should_grow():
+            async with self._connection_lock:
+                if self._should_grow():
+                    logger.debug("Opening new persistent rendering connection.")
+                    reader, writer = await self._new_connection()
+                    self._connections.append(RenderConnection(reader, writer))
+                    logger.debug("Acquired connection.")
+        return min(self._connections, key=lambda conn: len(conn.pending))
+
+    async def close(self):
+        """
+        Close all pooled connections.
+        """
+        connections, self._connections = self._connections, []
+        await asyncio.gather(*(conn.close() for conn in connections))
 
     @with_log_ctx(action="Render")
-    async def request(self, route: str, timeout: Optional[float]=None, **kwargs):
+    async def request(self, route: str, timeout: Optional[float]=None,
+                      priority: RenderPriority = RenderPriority.NORMAL, **kwargs):
         reqid = short_uuid()
         timeout = timeout or self.request_expiry
+        # The server will not start rendering the request after it has expired here
+        deadline = time.time() + timeout
         task = asyncio.create_task(
-            self._request(route, reqid=reqid, **kwargs),
+            self._request(route, reqid=reqid, priority=priority, deadline=deadline, **kwargs),
             name=f"Render {reqid}"
         )
         self._tasks[reqid] = task
@@ -161,40 +255,53 @@ class GUIclient:
             )
             raise
 
-    async def _request(self, route, args=(), reqid: Optional[str] = None, kwargs={}):
+    async def _request(self, route, args=(), reqid: Optional[str] = None, kwargs={},
+                       priority=RenderPriority.NORMAL, deadline=None):
         set_logging_context(action=route)
         logger.debug(
             f"Sending rendering request '{reqid}' to route {route!r} with args {args!r} and kwargs {kwargs!r}"
         )
-        async with self.connection() as connection:
-            render_start = time.time()
-            reader, writer = connection
-
-            packet = (route, args, kwargs)
-            encoded = pickle.dumps(packet)
-
-            writer.write(encoded)
-            writer.write_eof()
-
-            data = await reader.read(-1)
-            result = pickle.loads(data)
-
-            render_end = time.time()
+        key = request_key(route, args, kwargs)
+        cached = self._cache.get(key, None)
+
+        connection = await self.connection()
+        render_start = time.time()
+        response = await connection.send(
+            reqid, route, args, kwargs,
+            priority=priority, deadline=deadline, etag=cached[0] if cached else None
+        )
+        render_end = time.time()
 
-        if not result or not result['rqid']:
-            logger.error(f"Rendering server sent a malformed response: {result}")
-            raise RenderingFailure(f"Malformed render response {result}")
-        elif result['state'] != RequestState.SUCCESS:
+        if not response.rqid:
+            logger.error(f"Rendering server sent a malformed response: {response}")
+            raise RenderingFailure(f"Malformed render response {response}")
+        elif response.state == RequestState.UNCHANGED and cached and cached[0] == response.etag:
+            logger.debug(
+                f"Rendering unchanged after {render_end-render_start:.6f} seconds, using cached result. "
+                f"Response: {response}"
+            )
+            return cached[1]
+        elif response.state != RequestState.SUCCESS:
             logger.error(
-                f"Rendering failed! Response: {result}"
+                f"Rendering failed! Response: {response}"
             )
-            raise RenderingFailure(f"Rendering server returned {result}")
+            raise RenderingFailure(f"Rendering server returned {response}")
         else:
-            image_data = result.pop('data')
             logger.debug(
-                f"Rendering completed in {render_end-render_start:.6f} seconds. Response: {result}"
+                f"Rendering completed in {render_end-render_start:.6f} seconds. Response: {response}"
             )
-            return image_data
+            data = response.data
+            if response.etag is not None and _result_size((None, data)) <= self.cache_size:
+                self._cache[key] = (response.etag, data)
+            return data
+
+
+def _result_size(entry):
+    _, data = entry
+    if isinstance(data, list):
+        return sum(len(part) for part in data)
+    else:
+        return len(data)
 
 
 async def wait_until(aws, expiry: dt.datetime):
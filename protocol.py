@@ -0,0 +1,183 @@
+"""
+Wire protocol shared by the rendering client and server.
+
+Clients hold long-lived connections to the rendering server, and multiplex many requests over each one.
+Request and response frames are tagged with the client request id,
+so the server may answer requests in any order.
+
+Request frames consist of a fixed header (request id, priority, deadline, etag, and body length),
+followed by the pickled `(route, args, kwargs)` request body.
+The etag is the hash of a result the client already holds for this request,
+in which case the server may reply with an `UNCHANGED` state and no image data.
+The server only unpickles request bodies with a restricted unpickler, see `SafeUnpickler`.
+
+Response frames consist of a fixed header (request id, state, flags, duration, etag, error length, part count),
+followed by the utf-8 encoded error (if any), the length of each image part, and then the raw image parts.
+Image parts are written straight from the rendered buffers, and never pickled.
+"""
+import io
+import enum
+import struct
+import pickle
+
+RQID_LENGTH = 16
+ETAG_LENGTH = 16
+
+REQUEST_HEADER = struct.Struct(f'!{RQID_LENGTH}sBd{ETAG_LENGTH}sI')
+RESPONSE_HEADER = struct.Struct(f'!{RQID_LENGTH}sBBd{ETAG_LENGTH}sII')
+PART_LENGTH = struct.Struct('!I')
+
+# Response flags
+MULTIPART = 1 << 0
+
+
+class SafeUnpickler(pickle.Unpickler):
+    """
+    Unpickler restricted to plain data types, date and time types, and enums defined in this package.
+    Used to decode request bodies, so that a misbehaving client cannot execute arbitrary code on the server.
+    """
+    safe_globals = {
+        ('builtins', 'set'),
+        ('builtins', 'frozenset'),
+        ('builtins', 'complex'),
+        ('builtins', 'bytearray'),
+        ('builtins', 'range'),
+        ('builtins', 'slice'),
+        ('datetime', 'datetime'),
+        ('datetime', 'date'),
+        ('datetime', 'time'),
+        ('datetime', 'timedelta'),
+        ('datetime', 'timezone'),
+    }
+
+    def find_class(self, module, name):
+        if (module, name) in self.safe_globals:
+            return super().find_class(module, name)
+        if module == __package__ or module.startswith(f"{__package__}."):
+            obj = super().find_class(module, name)
+            if isinstance(obj, type) and issubclass(obj, enum.Enum):
+                return obj
+        raise pickle.UnpicklingError(f"Refusing to unpickle global '{module}.{name}' in rendering request.")
+
+
+def safe_loads(data: bytes):
+    """
+    Unpickle a request body with `SafeUnpickler`.
+    """
+    return SafeUnpickler(io.BytesIO(data)).load()
+
+
+class Response:
+    """
+    A decoded response frame.
+    """
+    __slots__ = ('rqid', 'state', 'flags', 'duration', 'etag', 'error', 'parts')
+
+    def __init__(self, rqid, state, flags, duration, etag, error, parts):
+        self.rqid = rqid
+        self.state = state
+        self.flags = flags
+        self.duration = duration
+        self.etag = etag
+        self.error = error
+        self.parts = parts
+
+    @property
+    def data(self):
+        """
+        The response image data.
+        Either a single bytestring, or a list of bytestrings for multi-page responses.
+        """
+        if self.flags & MULTIPART:
+            return self.parts
+        else:
+            return self.parts[0] if self.parts else b''
+
+    def __repr__(self):
+        return (
+            f"<Response rqid={self.rqid!r} state={self.state} duration={self.duration:.6f} "
+            f"error={self.error!r} lengths={[len(part) for part in self.parts]}>"
+        )
+
+
+def _encode_rqid(rqid: str) -> bytes:
+    return rqid.encode().ljust(RQID_LENGTH, b'\0')
+
+
+def _decode_rqid(data: bytes) -> str:
+    return data.rstrip(b'\0').decode()
+
+
+def _decode_etag(data: bytes):
+    return data if any(data) else None
+
+
+def write_request(writer, rqid, route, args, kwargs, priority=0, deadline=None, etag=None):
+    """
+    Write a single request frame to the provided `StreamWriter`.
+    `deadline` is an optional unix timestamp after which the server should not start rendering the request.
+    `etag` is the optional etag of a previous result for this request, held by the client.
+    """
+    body = pickle.dumps((route, args, kwargs))
+    writer.write(
+        REQUEST_HEADER.pack(_encode_rqid(rqid), int(priority), deadline or 0, etag or bytes(ETAG_LENGTH), len(body))
+    )
+    writer.write(body)
+
+
+async def read_request(reader):
+    """
+    Read a single request frame from the given `StreamReader`.
+    Returns the request id, priority, deadline (or `None`), etag (or `None`),
+    and the raw request body for decoding with `safe_loads`.
+    Raises `asyncio.IncompleteReadError` if the connection closes mid-frame or before a frame starts.
+    """
+    header = await reader.readexactly(REQUEST_HEADER.size)
+    rqid, priority, deadline, etag, length = REQUEST_HEADER.unpack(header)
+    body = await reader.readexactly(length)
+    return _decode_rqid(rqid), priority, deadline or None, _decode_etag(etag), body
+
+
+def write_response(writer, rqid, state, duration=0.0, error=None, data=b'', etag=None):
+    """
+    Write a single response frame to the provided `StreamWriter`.
+
+    `data` may be a single bytes-like object, or a list of bytes-like objects for multi-page responses.
+    Each image part is written directly as a memoryview, without copying or pickling.
+    The frame is written without yielding, so frames from concurrent tasks never interleave.
+    """
+    if isinstance(data, (list, tuple)):
+        parts = data
+        flags = MULTIPART
+    else:
+        parts = (data,) if data else ()
+        flags = 0
+    error_data = error.encode() if error else b''
+
+    writer.write(
+        RESPONSE_HEADER.pack(
+            _encode_rqid(rqid), int(state), flags, duration, etag or bytes(ETAG_LENGTH), len(error_data), len(parts)
+        )
+    )
+    if error_data:
+        writer.write(error_data)
+    if parts:
+        writer.write(b''.join(PART_LENGTH.pack(len(part)) for part in parts))
+        for part in parts:
+            writer.write(memoryview(part))
+
+
+async def read_response(reader) -> Response:
+    """
+    Read a single response frame from the given `StreamReader`.
+    Raises `asyncio.IncompleteReadError` if the connection closes mid-frame or before a frame starts.
+    """
+    header = await reader.readexactly(RESPONSE_HEADER.size)
+    rqid, state, flags, duration, etag, error_length, count = RESPONSE_HEADER.unpack(header)
+    error = (await reader.readexactly(error_length)).decode() if error_length else None
+    if count:
+        lengths = struct.unpack(f'!{count}I', await reader.readexactly(count * PART_LENGTH.size))
+        parts = [await reader.readexactly(length) for length in lengths]
+    else:
+        parts = []
+    return Response(_decode_rqid(rqid), state, flags, duration, _decode_etag(etag), error, parts)
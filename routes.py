@@ -2,11 +2,13 @@ import logging
 from . import cards
 
 routes = {}  # request name -> callable
+route_ttls = {}  # request name -> seconds a finished render may be served from the result cache
 
 
-def register_route(route_path):
+def register_route(route_path, cache_ttl=0):
     def wrapper(func):
         routes[route_path] = func
+        route_ttls[route_path] = cache_ttl
         return func
     return wrapper
 
@@ -14,7 +16,7 @@ def register_route(route_path):
 @register_route('ping')
 async def ping(runner, args, kwargs):
     logging.info("Ping-Pong!")
-    return b"Pong"
+    return b"Pong", None
 
 active_cards = [
     cards.StatsCard,
@@ -25,10 +27,11 @@ active_cards = [
     cards.WeeklyStatsCard,
     cards.TasklistCard,
     cards.LeaderboardCard,
+    cards.LeaderboardPagesCard,
     cards.BreakTimerCard,
     cards.FocusTimerCard
 ]
 
 
 for card in active_cards:
-    register_route(card.route)(card.card_route)
+    register_route(card.route, cache_ttl=card.cache_ttl)(card.card_route)
@@ -0,0 +1,99 @@
+"""
+Cache of finished rendering results.
+
+Results are keyed by the canonical request key (see `utils.request_key`),
+which covers the route, arguments, skin overrides, and locale of the request.
+The cache is bounded by the total size of the cached images, evicting least recently used results first,
+and each entry expires after the cache TTL of the route that rendered it.
+"""
+import time
+import logging
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class ResultCache:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+
+        # Map of request keys to (expiry, RenderResult), in least recently used order
+        self._entries = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        return {
+            'cache_entries': len(self),
+            'cache_bytes': self.size,
+            'cache_max_bytes': self.max_bytes,
+            'cache_hits': self.hits,
+            'cache_misses': self.misses,
+            'cache_evictions': self.evictions,
+        }
+
+    def get(self, key):
+        """
+        Retrieve the cached result for the given key, or `None` if not cached.
+        The caller holds a reference to the returned `RenderResult`, and must release it once written.
+        """
+        entry = self._entries.get(key, None)
+        if entry is not None and entry[0] < time.monotonic():
+            self._evict(key)
+            entry = None
+
+        if entry is None:
+            self.misses += 1
+            return None
+        else:
+            self.hits += 1
+            self._entries.move_to_end(key)
+            result = entry[1]
+            result.holders += 1
+            return result
+
+    def put(self, key, result, ttl):
+        """
+        Cache the given `RenderResult` for `ttl` seconds.
+        The cache takes its own reference to the result,
+        or a plain copy of results in shared memory, so that cached results don't hold segments open.
+        """
+        if ttl <= 0 or result.nbytes > self.max_bytes:
+            return
+        if key in self._entries:
+            self._evict(key)
+
+        self.expire()
+        if result.segments:
+            result = result.detached()
+        else:
+            result.holders += 1
+        self._entries[key] = (time.monotonic() + ttl, result)
+        self.size += result.nbytes
+
+        while self.size > self.max_bytes:
+            self._evict(next(iter(self._entries)))
+
+    def expire(self):
+        """
+        Evict all expired entries.
+        """
+        now = time.monotonic()
+        for key in [key for key, (expiry, _) in self._entries.items() if expiry < now]:
+            self._evict(key)
+
+    def clear(self):
+        for key in list(self._entries):
+            self._evict(key)
+
+    def _evict(self, key):
+        _, result = self._entries.pop(key)
+        self.size -= result.nbytes
+        self.evictions += 1
+        result.release()
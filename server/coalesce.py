@@ -0,0 +1,84 @@
+"""
+Coalescing of concurrent identical rendering requests.
+
+Requests are keyed by a canonical hash of their route and arguments (see `utils.request_key`).
+While a render for a key is in flight, further requests with the same key wait on that render,
+rather than submitting their own, and all of them share the resulting `RenderResult`.
+"""
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class _Render:
+    __slots__ = ('task', 'holders', 'settled')
+
+    def __init__(self, task):
+        self.task = task
+
+        # Number of requests waiting on, or holding, the result of this render
+        self.holders = 0
+
+        # Whether the result has been handed out to the holders
+        self.settled = False
+
+
+class Coalescer:
+    def __init__(self):
+        self.inflight: dict[str, _Render] = {}
+
+        self.renders = 0
+        self.coalesced = 0
+
+    def stats(self):
+        return {
+            'inflight': len(self.inflight),
+            'renders': self.renders,
+            'coalesced': self.coalesced,
+        }
+
+    async def render(self, key, render_coro_factory):
+        """
+        Return the `(result, state, error)` of the render with the given key,
+        starting a new render with `render_coro_factory()` if none is in flight.
+
+        The caller holds a reference to the returned `RenderResult`, and must release it once written.
+        """
+        entry = self.inflight.get(key, None)
+        if entry is None:
+            self.renders += 1
+            entry = _Render(asyncio.create_task(render_coro_factory()))
+            self.inflight[key] = entry
+            entry.task.add_done_callback(lambda task: self._settle(key, entry))
+        else:
+            self.coalesced += 1
+            logger.debug(f"Coalescing request with identical in-flight render {key!r}.")
+
+        entry.holders += 1
+        try:
+            return await asyncio.shield(entry.task)
+        except asyncio.CancelledError:
+            if entry.settled:
+                # We were counted as a holder of the result, so let go of our reference
+                if not entry.task.cancelled() and entry.task.exception() is None:
+                    entry.task.result()[0].release()
+            else:
+                entry.holders -= 1
+                if entry.holders == 0:
+                    # Nobody is waiting on this render any more
+                    # Forget it now, so identical requests arriving before it settles start a new render
+                    if self.inflight.get(key, None) is entry:
+                        self.inflight.pop(key)
+                    entry.task.cancel()
+            raise
+
+    def _settle(self, key, entry):
+        entry.settled = True
+        if self.inflight.get(key, None) is entry:
+            self.inflight.pop(key)
+        if not entry.task.cancelled() and entry.task.exception() is None:
+            # Hand the render's own reference over to the waiting holders
+            result = entry.task.result()[0]
+            result.holders += entry.holders
+            result.release()
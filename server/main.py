@@ -1,6 +1,8 @@
+import gc
+import copy
 import time
+import json
 import asyncio
-import pickle
 import logging
 import multiprocessing
 from contextvars import ContextVar, copy_context
@@ -10,10 +12,21 @@ from meta.logger import log_app, logging_context, log_context, log_action_stack,
 from meta.config import conf
 from babel.translator import LeoBabel, ctx_translator
 
-from ..routes import routes
-from ..utils import RequestState, short_uuid
+from ..routes import routes, route_ttls, register_route, active_cards
+from ..utils import RequestState, RenderPriority, request_key, reload_asset_index, skins_fingerprint
+from ..base.AppSkin import AppSkin
+from ..base.Skin import clear_field_cache
+from ..base.Avatars import avatar_manager, share_avatars, AvatarExpired
+from ..protocol import read_request, write_response, safe_loads
+from .shared import RenderResult, export_result, discard_result
+from .scheduler import RenderScheduler, RequestExpired
+from .coalesce import Coalescer
+from .cache import ResultCache
+from .memory import process_memory, format_memory
 
 requestid = ContextVar('requestid', default=None)
+request_priority = ContextVar('request_priority', default=RenderPriority.NORMAL)
+request_deadline = ContextVar('request_deadline', default=None)
 logger = logging.getLogger(__name__)
 
 for name in conf.config.options('LOGGING_LEVELS', no_defaults=True):
@@ -30,14 +43,72 @@ log_app.set("GUI_SERVER")
 PATH = conf.gui.get('socket_path')
 MAX_PROC = conf.gui.getint('process_count')
 
+# Whether workers should return rendered images through shared memory, rather than the executor pipe
+SHARED_RESULTS = conf.gui.getboolean('shared_results', fallback=False)
+
+# Locales to preload the default card skins for, as a comma separated list
+PRELOAD_LOCALES = [locale.strip() for locale in conf.gui.get('preload_locales', fallback='').split(',') if locale.strip()]
+
+# Process start method for the worker pool
+# With 'fork', preloaded skins are loaded once in the server process and shared copy-on-write with every worker
+START_METHOD = conf.gui.get('start_method', fallback='fork')
+
+# Seconds between checks for modified skin files, or 0 to disable skin reloading
+SKIN_RELOAD_INTERVAL = conf.gui.getint('skin_reload_interval', fallback=10)
+
+# Maximum total size of cached rendering results, in megabytes
+RESULT_CACHE_SIZE = conf.gui.getint('result_cache_size', fallback=256)
+
 executor: ProcessPoolExecutor = None
+skins_preloaded = False
+skin_generation = 0
+scheduler: RenderScheduler = None
+coalescer = Coalescer()
+result_cache = ResultCache(RESULT_CACHE_SIZE * 1024 * 1024)
 
 
-async def handle_request(reader, writer):
-    data = await reader.read()
-    route, args, kwargs = pickle.loads(data)
-    rqid = short_uuid()
+async def handle_connection(reader, writer):
+    """
+    Serve a persistent client connection.
+    Each request frame is handled in its own task, and responses are written back as they complete.
+    """
+    if SHARED_RESULTS:
+        # Only resume writers once the transport buffer has fully flushed,
+        # so that shared result segments are no longer referenced when they are released.
+        writer.transport.set_write_buffer_limits(high=0)
+
+    tasks = set()
+    try:
+        while True:
+            try:
+                rqid, priority, deadline, etag, body = await read_request(reader)
+            except (asyncio.IncompleteReadError, ConnectionError):
+                break
+            task = asyncio.create_task(handle_request(rqid, priority, deadline, etag, body, writer))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+    finally:
+        for task in tasks:
+            task.cancel()
+        if not writer.is_closing():
+            writer.close()
+        try:
+            await writer.wait_closed()
+        except ConnectionError:
+            pass
+
+
+async def handle_request(rqid, priority, deadline, etag, body, writer):
     requestid.set(rqid)
+    request_priority.set(priority)
+    request_deadline.set(deadline)
+    start = time.time()
+
+    try:
+        route, args, kwargs = safe_loads(body)
+    except Exception as e:
+        logger.warning(f"Could not decode rendering request {rqid!r}.", exc_info=True)
+        return await respond(writer, rqid, RequestState.SYSTEM_ERROR, error=repr(e))
 
     set_logging_context(context=f"RQID: {rqid}", action=f"ROUTE {route}")
     logger.debug(
@@ -45,62 +116,103 @@ async def handle_request(reader, writer):
     )
 
     if route in routes:
-        try:
-            start = time.time()
-            data, error = await routes[route](runner, args, kwargs)
-            if error is None:
-                state = RequestState.SUCCESS
-            else:
-                state = RequestState.RENDER_ERROR
-        except Exception as e:
-            logger.error(
-                "Unhandled server exception encountered while rendering request.",
-                exc_info=True
-            )
-            data, error = b'', repr(e)
-            state = RequestState.SYSTEM_ERROR
+        key = request_key(route, args, kwargs)
+        if (result := result_cache.get(key)) is not None:
+            logger.debug(f"Serving request from result cache with key {key!r}.")
+            state, error = RequestState.SUCCESS, None
+        else:
+            result, state, error = await coalescer.render(key, lambda: render(key, route, args, kwargs))
 
         dur = time.time() - start
-
-        payload = {
-            'rqid': rqid,
-            'state': state.value,
-            'data': data,
-            'length': len(data),
-            'error': error,
-            'duration': dur
-        }
         logger.debug(
             f"Request complete with status {state.name} in {dur:.6f} seconds."
         )
+        try:
+            if etag is not None and result.etag == etag:
+                # The client already holds this result
+                await respond(writer, rqid, RequestState.UNCHANGED, duration=dur, etag=etag)
+            else:
+                await respond(writer, rqid, state, duration=dur, error=error, data=result.data, etag=result.etag)
+        finally:
+            result.release()
     else:
         logger.warning(f"Unhandled route requested {route!r}")
-        payload = {
-            'rqid': rqid,
-            'state': int(RequestState.UNKNOWN_ROUTE),
-        }
+        await respond(writer, rqid, RequestState.UNKNOWN_ROUTE)
+
+
+async def render(key, route, args, kwargs):
+    """
+    Execute the given rendering route, caching the result under `key` if successful.
+    Returns the `RenderResult`, the request state, and the error if any.
+    """
+    try:
+        try:
+            # Routes may replace their arguments, so keep the originals for a retry
+            data, error = await routes[route](runner, copy.deepcopy(args), copy.deepcopy(kwargs))
+        except AvatarExpired:
+            logger.info("Shared avatar was unlinked before rendering, retrying with avatars sent by value.")
+            share_avatars.set(False)
+            data, error = await routes[route](runner, args, kwargs)
+        if error is None:
+            state = RequestState.SUCCESS
+        else:
+            state = RequestState.RENDER_ERROR
+    except RequestExpired:
+        data, error = b'', "Request expired before rendering."
+        state = RequestState.EXPIRED
+    except Exception as e:
+        logger.error(
+            "Unhandled server exception encountered while rendering request.",
+            exc_info=True
+        )
+        data, error = b'', repr(e)
+        state = RequestState.SYSTEM_ERROR
 
-    response = pickle.dumps(payload)
-    writer.write(response)
-    writer.write_eof()
+    try:
+        result = RenderResult(data)
+    except Exception as e:
+        logger.error(
+            "Could not attach to the shared rendering result.",
+            exc_info=True
+        )
+        result, error = RenderResult(b''), repr(e)
+        state = RequestState.SYSTEM_ERROR
+
+    if state is RequestState.SUCCESS:
+        # hashlib releases the GIL on large buffers, so hash off the event loop
+        try:
+            result.etag = await asyncio.to_thread(result.digest)
+        except asyncio.CancelledError:
+            result.release()
+            raise
+        result_cache.put(key, result, route_ttls.get(route, 0))
+    return result, state, error
 
+
+async def respond(writer, rqid, state, **kwargs):
+    if writer.is_closing():
+        logger.info("Request was cancelled.")
+        return
+
+    write_response(writer, rqid, state, **kwargs)
     try:
         await writer.drain()
     except ConnectionResetError:
         logger.info("Request was cancelled.")
-    finally:
-        if not writer.is_closing():
-            writer.close()
-            await writer.wait_closed()
 
 
 def _execute(ctx, method, args, kwargs):
     requestid.set(ctx[0])
     log_context.set(ctx[1])
     log_action_stack.set(ctx[2])
+    if ctx[3] > skin_generation:
+        reload_skins(ctx[3])
     try:
         result = method(*args, **kwargs)
         error = None
+    except AvatarExpired:
+        # Retried by the server
+        raise
     except Exception as e:
         logger.exception(
             "Unhandled exception occurred while executing route.",
@@ -109,6 +221,8 @@ def _execute(ctx, method, args, kwargs):
         )
         result = b''
         error = repr(e)
+    if SHARED_RESULTS and error is None and result:
+        result = export_result(result)
     return result, error
 
 
@@ -118,16 +232,71 @@ async def runner(method, args, kwargs):
     Abstracts the executor implementation away from specific routes.
     Also allows transparently sending variables into the execution context (e.g. rqid).
     """
-    return await asyncio.get_event_loop().run_in_executor(
-        executor,
+    return await scheduler.submit(
         _execute,
-        (requestid.get(), log_context.get(), log_action_stack.get()),
+        (requestid.get(), log_context.get(), log_action_stack.get(), skin_generation),
         method,
         args,
-        kwargs
+        kwargs,
+        priority=request_priority.get(),
+        deadline=request_deadline.get(),
     )
 
 
+def _discard(result):
+    # Results of cancelled requests are never attached to, so free them
+    discard_result(result[0])
+
+
+@register_route('stats')
+async def stats(runner, args, kwargs):
+    """
+    Report the current state of the rendering scheduler, coalescer, and result cache,
+    along with the memory usage of the server and each worker process (in kB), as a JSON object.
+    """
+    memory = {'server': process_memory()}
+    for pid in list(executor._processes or ()):
+        memory[str(pid)] = process_memory(pid)
+    return json.dumps({
+        **scheduler.stats(),
+        **coalescer.stats(),
+        **result_cache.stats(),
+        'memory': memory,
+    }).encode(), None
+
+
+def reload_skins(generation):
+    """
+    Discard all loaded skin data in this process, so that it is read again from the skin files.
+    """
+    global skin_generation
+    skin_generation = generation
+    # Reopens the skin bundle, which the skin map is read from
+    reload_asset_index()
+    AppSkin.reload()
+    clear_field_cache()
+    logger.info(f"Reloaded skins, now at generation {generation}.")
+
+
+async def watch_skins():
+    """
+    Poll the skins directory for changes, and reload the skins when it is modified.
+    Workers reload when they next receive a request from the new generation.
+    """
+    fingerprint = await asyncio.to_thread(skins_fingerprint)
+    while True:
+        await asyncio.sleep(SKIN_RELOAD_INTERVAL)
+        try:
+            new_fingerprint = await asyncio.to_thread(skins_fingerprint)
+            if new_fingerprint != fingerprint:
+                fingerprint = new_fingerprint
+                logger.info("Skin files modified, reloading skins.")
+                reload_skins(skin_generation + 1)
+                result_cache.clear()
+        except Exception:
+            logger.exception("Unexpected exception while checking for modified skin files.")
+
+
 def worker_configurer():
     name = multiprocessing.current_process().name
     _, _, n = name.partition('-')
@@ -140,31 +309,75 @@ def worker_configurer():
     translator._load()
     ctx_translator.set(translator)
 
+    if PRELOAD_LOCALES and not skins_preloaded:
+        # Not inherited from the server process, load our own
+        preload_skins()
+    logger.info(f"Pool process {name} memory usage: {format_memory(process_memory())}")
+
+
+def preload_skins():
+    """
+    Load the default skin of every active card, in every preload locale, into this process' skin cache.
+    """
+    global skins_preloaded
+    start = time.time()
+    for card in active_cards:
+        for locale in PRELOAD_LOCALES:
+            try:
+                card.preload_skin(locale)
+            except Exception:
+                logger.exception(f"Could not preload skin for card {card.card_id!r} in locale {locale!r}.")
+    # Keep the long-lived preloaded objects out of the per-render garbage collections
+    # This also stops collections from writing to them, which would unshare forked pages
+    gc.freeze()
+    skins_preloaded = True
+    logger.info(
+        f"Preloaded {len(active_cards)} card skins in {len(PRELOAD_LOCALES)} locales "
+        f"in {time.time() - start:.3f} seconds."
+    )
+
 
 async def main():
     # logging_queue = multiprocessing.Manager().Queue(-1)
     # threading.Thread(target=logger_thread, args=(logging_queue,)).start()
     logger.debug("Test")
 
-    global executor
+    global executor, scheduler
     log_app.set("GUI_SERVER")
     translator = LeoBabel()
     translator._load()
     ctx_translator.set(translator)
 
     with logging_context(action='SPAWN'):
-        executor = ProcessPoolExecutor(MAX_PROC, initializer=worker_configurer)
+        AppSkin.preload([None, *PRELOAD_LOCALES])
+        if PRELOAD_LOCALES and START_METHOD == 'fork':
+            # Decode the skin assets once here, forked workers share them copy-on-write
+            preload_skins()
+            logger.info(f"Server process memory usage after preloading: {format_memory(process_memory())}")
+        executor = ProcessPoolExecutor(
+            MAX_PROC,
+            mp_context=multiprocessing.get_context(START_METHOD),
+            initializer=worker_configurer
+        )
+        scheduler = RenderScheduler(executor, MAX_PROC, discard=_discard if SHARED_RESULTS else None)
         executor.submit(worker_configurer)
         # for i in range(MAX_PROC):
         #     executor.submit(worker_configurer)
 
     with logging_context(stack=["SERV"]):
-        server = await asyncio.start_unix_server(handle_request, PATH)
+        server = await asyncio.start_unix_server(handle_connection, PATH)
         addrs = ', '.join(str(sock.getsockname()) for sock in server.sockets)
         logger.info(f'Serving on socket: {addrs}')
 
-        async with server:
-            await server.serve_forever()
+        if SKIN_RELOAD_INTERVAL > 0:
+            watcher = asyncio.create_task(watch_skins())
+        defaults = asyncio.create_task(avatar_manager().preload_defaults())
+
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            await avatar_manager().close()
 
 
 if __name__ == '__main__':
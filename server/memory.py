@@ -0,0 +1,47 @@
+"""
+Resident memory reporting for the rendering server and its pool workers.
+
+Reads the kernel's summary of each process' memory mappings,
+distinguishing memory shared copy-on-write with the server process from private memory.
+"""
+import logging
+
+logger = logging.getLogger(__name__)
+
+_fields = {
+    'Rss': 'rss',
+    'Pss': 'pss',
+    'Shared_Clean': 'shared_clean',
+    'Shared_Dirty': 'shared_dirty',
+    'Private_Clean': 'private_clean',
+    'Private_Dirty': 'private_dirty',
+}
+
+
+def process_memory(pid='self') -> dict:
+    """
+    Memory usage of the given process in kB, as reported by `/proc/<pid>/smaps_rollup`.
+    Returns an empty dict where this is unavailable.
+    """
+    usage = {}
+    try:
+        with open(f"/proc/{pid}/smaps_rollup", 'r') as f:
+            for line in f:
+                name, _, value = line.partition(':')
+                if name in _fields:
+                    usage[_fields[name]] = int(value.split()[0])
+    except OSError:
+        pass
+    return usage
+
+
+def format_memory(usage: dict) -> str:
+    if not usage:
+        return "unavailable"
+    shared = usage.get('shared_clean', 0) + usage.get('shared_dirty', 0)
+    private = usage.get('private_clean', 0) + usage.get('private_dirty', 0)
+    return (
+        f"RSS {usage.get('rss', 0) / 1024:.1f} MB "
+        f"(shared {shared / 1024:.1f} MB, private {private / 1024:.1f} MB), "
+        f"PSS {usage.get('pss', 0) / 1024:.1f} MB"
+    )
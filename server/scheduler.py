@@ -0,0 +1,134 @@
+"""
+Priority and deadline aware scheduling of rendering jobs onto the process pool.
+
+Jobs are held in a priority queue in the server process, and only dispatched to the executor
+when a worker slot is free, so that queued jobs can still be reordered or dropped.
+Jobs are ordered by priority, then by deadline, then by arrival.
+Jobs whose deadline has passed before a slot frees up are dropped without rendering.
+"""
+import time
+import heapq
+import asyncio
+import itertools
+import logging
+from collections import Counter
+
+logger = logging.getLogger(__name__)
+
+
+class RequestExpired(Exception):
+    """
+    The request deadline passed before the job could be dispatched.
+    """
+    ...
+
+
+class _Job:
+    __slots__ = ('future', 'func', 'args', 'priority', 'deadline', 'queued_at')
+
+    def __init__(self, future, func, args, priority, deadline):
+        self.future = future
+        self.func = func
+        self.args = args
+        self.priority = priority
+        self.deadline = deadline
+        self.queued_at = time.time()
+
+
+class RenderScheduler:
+    def __init__(self, executor, slots, discard=None):
+        self.executor = executor
+
+        # Maximum number of jobs dispatched to the executor at once
+        self.slots = slots
+
+        # Optional callback run on the results of jobs completing after their request was cancelled
+        self.discard = discard
+
+        self._queue = []  # Heap of (priority, deadline, seq, job)
+        self._seq = itertools.count()
+        self.running = 0
+
+        self.completed = 0
+        self.expired = 0
+        self.cancelled = 0
+
+    @property
+    def depth(self):
+        """
+        Number of jobs waiting for a free worker slot.
+        """
+        return len(self._queue)
+
+    def stats(self):
+        return {
+            'queue_depth': self.depth,
+            'queued_by_priority': dict(Counter(int(job.priority) for *_, job in self._queue)),
+            'running': self.running,
+            'slots': self.slots,
+            'completed': self.completed,
+            'expired': self.expired,
+            'cancelled': self.cancelled,
+        }
+
+    def submit(self, func, *args, priority=0, deadline=None) -> asyncio.Future:
+        """
+        Queue `func(*args)` for execution in the executor.
+        Returns a future resolving to the result of the call,
+        or raising `RequestExpired` if the deadline passed before it could be dispatched.
+        """
+        future = asyncio.get_running_loop().create_future()
+        job = _Job(future, func, args, priority, deadline)
+        heapq.heappush(
+            self._queue,
+            (priority, deadline or float('inf'), next(self._seq), job)
+        )
+        if self.running >= self.slots:
+            logger.debug(
+                f"All {self.slots} rendering slots busy, queued job with priority {priority}. "
+                f"Queue depth: {self.depth}"
+            )
+        self._dispatch()
+        return future
+
+    def _dispatch(self):
+        loop = asyncio.get_running_loop()
+        now = time.time()
+        while self.running < self.slots and self._queue:
+            *_, job = heapq.heappop(self._queue)
+            if job.future.done():
+                # Cancelled while waiting in the queue
+                self.cancelled += 1
+                continue
+            if job.deadline is not None and job.deadline < now:
+                self.expired += 1
+                logger.info(
+                    f"Dropping rendering job which expired after queueing for {now - job.queued_at:.3f} seconds."
+                )
+                job.future.set_exception(RequestExpired())
+                continue
+
+            try:
+                cfuture = self.executor.submit(job.func, *job.args)
+            except Exception as e:
+                # E.g. the pool broke after a worker died, fail the job rather than leaving it waiting
+                logger.error("Could not submit rendering job to the executor.", exc_info=True)
+                job.future.set_exception(e)
+                continue
+            self.running += 1
+            cfuture.add_done_callback(
+                lambda cfuture, job=job: loop.call_soon_threadsafe(self._complete, job, cfuture)
+            )
+
+    def _complete(self, job, cfuture):
+        self.running -= 1
+        self.completed += 1
+        if job.future.done():
+            self.cancelled += 1
+            if self.discard is not None and not cfuture.cancelled() and cfuture.exception() is None:
+                self.discard(cfuture.result())
+        elif (exception := cfuture.exception()) is not None:
+            job.future.set_exception(exception)
+        else:
+            job.future.set_result(cfuture.result())
+        self._dispatch()
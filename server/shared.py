@@ -0,0 +1,160 @@
+"""
+Shared memory transfer of rendered images from pool workers to the server process.
+
+When enabled, workers write each encoded image part into its own shared memory segment,
+and only return a small `SharedParts` handle through the executor pipe.
+The server attaches to the segments and streams them straight to the client socket,
+then unlinks them once the response has been flushed.
+"""
+import sys
+import hashlib
+import logging
+from multiprocessing import shared_memory, resource_tracker
+
+from ..protocol import ETAG_LENGTH
+
+logger = logging.getLogger(__name__)
+
+
+class SharedParts:
+    """
+    Picklable handle to rendered image parts stored in shared memory segments.
+    """
+    __slots__ = ('names', 'sizes', 'multipart')
+
+    def __init__(self, names, sizes, multipart):
+        self.names = names
+        self.sizes = sizes
+        self.multipart = multipart
+
+    def __repr__(self):
+        return f"<SharedParts names={self.names!r} sizes={self.sizes!r}>"
+
+
+def _create_segment(size):
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(create=True, size=size, track=False)
+    else:
+        shm = shared_memory.SharedMemory(create=True, size=size)
+        # The server process takes ownership and unlinks the segment,
+        # so stop this worker's resource tracker from unlinking it when the worker exits.
+        resource_tracker.unregister(shm._name, 'shared_memory')
+        return shm
+
+
+def export_result(data) -> SharedParts:
+    """
+    Worker side.
+    Copy the given image data (a bytestring or list of bytestrings) into new shared memory segments.
+    """
+    multipart = isinstance(data, (list, tuple))
+    parts = data if multipart else (data,)
+
+    segments = []
+    try:
+        for part in parts:
+            shm = _create_segment(max(len(part), 1))
+            segments.append(shm)
+            shm.buf[:len(part)] = part
+    except Exception:
+        for shm in segments:
+            shm.close()
+            shm.unlink()
+        raise
+
+    names = [shm.name for shm in segments]
+    for shm in segments:
+        shm.close()
+    return SharedParts(names, [len(part) for part in parts], multipart)
+
+
+def discard_result(data):
+    """
+    Unlink the shared memory segments of a result that will never be sent.
+    Plain results are ignored.
+    """
+    if isinstance(data, SharedParts):
+        for name in data.names:
+            try:
+                shm = shared_memory.SharedMemory(name=name)
+            except FileNotFoundError:
+                continue
+            shm.unlink()
+            shm.close()
+
+
+class RenderResult:
+    """
+    Server side view of a route result.
+
+    Wraps either plain image data returned through the executor,
+    or image parts attached from the shared memory segments described by a `SharedParts` handle.
+    Results may be shared between several holders (e.g. coalesced requests).
+    Each holder must call `release` once it has written the result,
+    and any attached segments are freed when the last holder releases.
+    """
+    __slots__ = ('data', 'segments', 'holders', 'etag')
+
+    def __init__(self, data):
+        self.holders = 1
+        self.etag = None
+        self.segments = []
+        if isinstance(data, SharedParts):
+            views = []
+            try:
+                for name, size in zip(data.names, data.sizes):
+                    shm = shared_memory.SharedMemory(name=name)
+                    self.segments.append(shm)
+                    views.append(shm.buf[:size])
+            except Exception:
+                self.release()
+                raise
+            self.data = views if data.multipart else views[0]
+        else:
+            self.data = data
+
+    @property
+    def nbytes(self):
+        if isinstance(self.data, (list, tuple)):
+            return sum(len(part) for part in self.data)
+        else:
+            return len(self.data)
+
+    def detached(self) -> 'RenderResult':
+        """
+        New result holding a plain copy of the image data, independent of any shared memory segments.
+        """
+        if isinstance(self.data, (list, tuple)):
+            result = RenderResult([bytes(part) for part in self.data])
+        else:
+            result = RenderResult(bytes(self.data))
+        result.etag = self.etag
+        return result
+
+    def digest(self) -> bytes:
+        """
+        Compute a hash of the image data, for use as the result etag.
+        """
+        hasher = hashlib.blake2b(digest_size=ETAG_LENGTH)
+        for part in (self.data if isinstance(self.data, (list, tuple)) else (self.data,)):
+            hasher.update(part)
+        return hasher.digest()
+
+    def release(self):
+        self.holders -= 1
+        if self.holders > 0:
+            return
+
+        segments, self.segments = self.segments, []
+        self.data = b''
+        for shm in segments:
+            try:
+                shm.unlink()
+            except FileNotFoundError:
+                pass
+            try:
+                shm.close()
+            except BufferError:
+                # The transport still holds views onto the segment.
+                # The mapping is freed when the views are dropped.
+                logger.debug(f"Deferred closing shared result segment {shm.name!r}.")
@@ -0,0 +1,111 @@
+import os
+import tempfile
+import unittest
+from io import BytesIO
+from unittest import mock
+
+from aiohttp import web
+from PIL import Image
+
+from ..base import Avatars as avatars_module
+from ..base.Avatars import Avatars, AvatarDiskCache
+
+AVATAR_COLOUR = '#DDB21D'
+
+
+def _png(size, colour):
+    with BytesIO() as buffer:
+        Image.new('RGBA', (size, size), colour).save(buffer, format='PNG')
+        return buffer.getvalue()
+
+
+def _directory_size(directory):
+    return sum(
+        os.path.getsize(os.path.join(root, name))
+        for root, _, files in os.walk(directory)
+        for name in files
+    )
+
+
+class TestAvatarDiskCache(unittest.IsolatedAsyncioTestCase):
+    """
+    Fetch avatars through the disk cache, from a local stand-in for the Discord CDN.
+    """
+    async def asyncSetUp(self):
+        self.requests = []
+
+        async def avatar(request):
+            self.requests.append(request.path)
+            return web.Response(body=_png(int(request.query.get('size', 128)), AVATAR_COLOUR), content_type='image/png')
+
+        app = web.Application()
+        app.router.add_get('/avatars/{uid}/{name}', avatar)
+        app.router.add_get('/embed/avatars/{name}', avatar)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+        port = self.runner.addresses[0][1]
+
+        patcher = mock.patch.object(avatars_module, 'DISCORD_BASE', f"http://127.0.0.1:{port}")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+
+    async def asyncTearDown(self):
+        await self.runner.cleanup()
+
+    def _manager(self, max_bytes=1024 * 1024):
+        manager = Avatars()
+        manager.disk = AvatarDiskCache(self.tmpdir.name, max_bytes)
+        return manager
+
+    async def test_disk_hit_skips_network(self):
+        manager = self._manager()
+        try:
+            avatar = await manager.get_avatar(1, 'abc', 256)
+        finally:
+            await manager.close()
+        self.assertIsNotNone(avatar)
+        self.assertEqual(len(self.requests), 1)
+
+        # A fresh manager, as after a restart, reads the avatar from disk
+        manager = self._manager()
+        try:
+            avatar = await manager.get_avatar(1, 'abc', 256)
+        finally:
+            await manager.close()
+        self.assertIsNotNone(avatar)
+        self.assertEqual(avatar.size, (256, 256))
+        self.assertEqual(len(self.requests), 1)
+
+    async def test_eviction_bounds_directory(self):
+        # Every fetched avatar is stored as the same 512px PNG
+        data = _png(512, AVATAR_COLOUR)
+        max_bytes = 5 * len(data)
+        manager = self._manager(max_bytes)
+        try:
+            for userid in range(5):
+                await manager.get_avatar(userid, 'abc', 512)
+            self.assertLessEqual(_directory_size(self.tmpdir.name), max_bytes)
+
+            # The sixth avatar goes over the bound
+            await manager.get_avatar(5, 'abc', 512)
+        finally:
+            await manager.close()
+        self.assertEqual(len(self.requests), 6)
+        self.assertLessEqual(_directory_size(self.tmpdir.name), max_bytes * 0.9)
+
+    def test_overwrite_does_not_grow_size(self):
+        cache = AvatarDiskCache(self.tmpdir.name, 1024 * 1024)
+        data = _png(64, '#FFFFFF')
+        for _ in range(10):
+            cache.write((1, 'abc', 64), data)
+        self.assertEqual(cache.size, len(data))
+        self.assertEqual(cache.read((1, 'abc', 64)), data)
+
+
+if __name__ == '__main__':
+    unittest.main()
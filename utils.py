@@ -1,15 +1,20 @@
 import io
 import os
+import hashlib
+import functools
 import discord
 from enum import IntEnum
 import logging
 import string
 import random
 
-from PIL import ImageFont
+from PIL import Image, ImageFont
+from cachetools import LRUCache
 
 from meta import conf
 
+from .bundle import SkinBundle
+
 logger = logging.getLogger(__name__)
 
 
@@ -18,6 +23,18 @@ class RequestState(IntEnum):
     UNKNOWN_ROUTE = 1
     SYSTEM_ERROR = 2
     RENDER_ERROR = 3
+    EXPIRED = 4
+    UNCHANGED = 5
+
+
+class RenderPriority(IntEnum):
+    """
+    Scheduling priority of a rendering request.
+    Lower values are dispatched first.
+    """
+    INTERACTIVE = 0
+    NORMAL = 1
+    PERIODIC = 2
 
 
 __location__ = os.path.realpath(os.path.join(os.getcwd(), os.path.dirname(__file__)))
@@ -32,15 +49,130 @@ def asset_path(asset):
     return skin_path_join('base', 'assets', asset)
 
 
+# Compiled skin bundle to read skin files from, instead of the skins directory, if configured
+SKIN_BUNDLE_PATH = conf.gui.get('skin_bundle', fallback=None)
+skin_bundle: SkinBundle = None
+
+
+def load_skin_bundle():
+    """
+    Open the configured skin bundle.
+    If the bundle cannot be opened (e.g. it has not been built yet), skins are read from the skins directory instead.
+    """
+    global skin_bundle
+    skin_bundle = None
+    if SKIN_BUNDLE_PATH:
+        try:
+            skin_bundle = SkinBundle(SKIN_BUNDLE_PATH)
+        except (OSError, ValueError):
+            logger.exception(
+                f"Could not open skin bundle {SKIN_BUNDLE_PATH!r}, reading skins from '{__skins_location__}' instead."
+            )
+
+
+load_skin_bundle()
+
+
+def _skins_relpath(path):
+    """
+    Path of the given file relative to the skins directory, or `None` if it is outside the skins directory.
+    """
+    path = os.path.normpath(path)
+    if os.path.isabs(path) or path.split(os.sep, 1)[0] != os.path.normpath(__skins_location__):
+        return None
+    return os.path.relpath(path, __skins_location__)
+
+
+# Set of normalised paths of every file under the skins directory, built on first use
+_asset_index = None
+
+# Map of (PATH, asset_path) -> resolved asset path
+_resolved_assets = {}
+
+
+def _build_asset_index():
+    index = set()
+    for root, _, files in os.walk(__skins_location__):
+        for file in files:
+            index.add(os.path.normpath(os.path.join(root, file)))
+    logger.debug(f"Indexed {len(index)} skin files under '{__skins_location__}'.")
+    return index
+
+
+def reload_asset_index():
+    """
+    Reopen the skin bundle, rebuild the index of skin files, and forget all resolved asset paths.
+    Should be run whenever the skins directory or bundle is modified.
+    """
+    global _asset_index
+    load_skin_bundle()
+    _asset_index = _build_asset_index()
+    _resolved_assets.clear()
+
+
+def skins_fingerprint():
+    """
+    Cheap fingerprint of the skins directory, which changes whenever a skin file is added, removed, or modified.
+    When using a skin bundle, this instead changes whenever the bundle is replaced.
+    """
+    if SKIN_BUNDLE_PATH:
+        try:
+            stat = os.stat(SKIN_BUNDLE_PATH)
+        except FileNotFoundError:
+            return None
+        return (stat.st_ino, stat.st_mtime_ns)
+
+    count = 0
+    latest = 0
+    for root, dirs, files in os.walk(__skins_location__):
+        for name in (*dirs, *files):
+            try:
+                latest = max(latest, os.stat(os.path.join(root, name)).st_mtime_ns)
+            except OSError:
+                continue
+            count += 1
+    return (count, latest)
+
+
+def asset_exists(path):
+    """
+    Whether the given file exists.
+    Files under the skins directory are checked against the skin bundle or asset index, rather than the filesystem.
+    """
+    global _asset_index
+    if (relpath := _skins_relpath(path)) is None:
+        return os.path.exists(path)
+    if skin_bundle is not None:
+        return relpath in skin_bundle
+    if _asset_index is None:
+        _asset_index = _build_asset_index()
+    return os.path.normpath(path) in _asset_index
+
+
+def read_skin_file(path) -> bytes:
+    """
+    Contents of the given file, read from the skin bundle if it holds the file.
+    """
+    if skin_bundle is not None and (relpath := _skins_relpath(path)) in skin_bundle.files:
+        return bytes(skin_bundle.read(relpath))
+    with open(path, 'rb') as f:
+        return f.read()
+
+
 def resolve_asset_path(PATH, asset_path):
     """
     Searches for the `asset_path` among the paths in `PATH`.
     `PATH` should be provided in increasing priority order.
     Returns the absolute path of the asset, if found.
     """
+    key = (tuple(PATH), asset_path)
+    if (resolved := _resolved_assets.get(key, None)) is not None:
+        return resolved
+
     for path in reversed(PATH):
         try_path = os.path.join(path, asset_path)
-        if os.path.exists(try_path):
+        if asset_exists(try_path):
+            _resolved_assets[key] = try_path
             return try_path
     logger.error(
         f"Could not resolve asset path '{asset_path}' in PATH: '{PATH}'"
@@ -49,18 +181,114 @@ def resolve_asset_path(PATH, asset_path):
     return None
 
 
+# Maximum total size of decoded assets to keep in each process, in megabytes
+ASSET_CACHE_SIZE = conf.gui.getint('asset_cache_size', fallback=256)
+
+
+def image_nbytes(image):
+    """
+    Approximate size of the decoded image data, in bytes.
+    """
+    return image.width * image.height * len(image.getbands())
+
+
+def cache_put(cache, key, value) -> bool:
+    """
+    Store the value in the given size-bounded cache, unless it is too large to cache.
+    Returns whether the value was cached.
+    """
+    try:
+        cache[key] = value
+    except ValueError:
+        return False
+    return True
+
+
+# Map of (path, mtime, convert) -> decoded Image, bounded by the decoded size
+_asset_cache = LRUCache(ASSET_CACHE_SIZE * 1024 * 1024, getsizeof=image_nbytes)
+_asset_cache_hits = 0
+_asset_cache_misses = 0
+
+
+def open_asset(path, convert=None):
+    """
+    Open the image asset at the given path, optionally converting it to the given mode.
+    Decoded assets are cached per process, and each call returns a fresh copy,
+    so the caller owns the returned image and may modify or close it.
+    """
+    global _asset_cache_hits, _asset_cache_misses
+    if skin_bundle is not None and (relpath := _skins_relpath(path)) in skin_bundle.images:
+        # Already decoded in the bundle, and shared between processes through the page cache
+        image = skin_bundle.image(relpath)
+        return image.convert(convert) if convert else image.copy()
+
+    key = (path, os.stat(path).st_mtime_ns, convert)
+    if (image := _asset_cache.get(key, None)) is None:
+        _asset_cache_misses += 1
+        with Image.open(path) as opened:
+            image = opened.convert(convert) if convert else opened.copy()
+        if not cache_put(_asset_cache, key, image):
+            return image
+    else:
+        _asset_cache_hits += 1
+    return image.copy()
+
+
+def asset_cache_info():
+    """
+    Statistics of the per-process decoded asset cache, as a dict.
+    """
+    return {
+        'hits': _asset_cache_hits,
+        'misses': _asset_cache_misses,
+        'entries': len(_asset_cache),
+        'bytes': _asset_cache.currsize,
+        'max_bytes': _asset_cache.maxsize,
+    }
+
+
 def inter_font(name, **kwargs):
     return get_font('Inter', name, **kwargs)
 
 
-def get_font(family, name, **kwargs):
+# Maximum number of loaded fonts to keep in each process
+FONT_CACHE_SIZE = conf.gui.getint('font_cache_size', fallback=512)
+
+
+def get_font(family, name, size=10, layout_engine=None, **kwargs):
+    """
+    Retrieve the font with the given family, weight name, and size.
+    Fonts are shared between renders in this process, and must not be modified.
+    """
+    if kwargs:
+        # Uncommon font options are not cached
+        return _load_font(family, name, size, layout_engine, **kwargs)
+    return _cached_font(family, name, size, layout_engine)
+
+
+def _load_font(family, name, size, layout_engine, **kwargs):
+    path = asset_path(f"fonts/{family}/{family}-{name}.ttf")
+    if skin_bundle is not None and (relpath := _skins_relpath(path)) in skin_bundle.files:
+        path = io.BytesIO(skin_bundle.read(relpath))
     return ImageFont.truetype(
-        asset_path(f"fonts/{family}/{family}-{name}.ttf"),
+        path,
+        size=size,
         # layout_engine=ImageFont.Layout.BASIC,
+        layout_engine=layout_engine,
         **kwargs
     )
 
 
+_cached_font = functools.lru_cache(maxsize=FONT_CACHE_SIZE)(_load_font)
+
+
+def font_cache_info():
+    """
+    Statistics of the per-process font cache, as a dict.
+    """
+    return _cached_font.cache_info()._asdict()
+
+
 def font_height(font: ImageFont):
     ascent, descent = font.getmetrics()
     return ascent + descent
@@ -90,6 +318,29 @@ def get_avatar_key(client, userid):
     return (userid, hash)
 
 
+def _canonical(obj):
+    """
+    Convert request arguments into an order-independent structure with a stable repr.
+    """
+    if isinstance(obj, dict):
+        return ('dict', tuple(sorted(((_canonical(k), _canonical(v)) for k, v in obj.items()), key=repr)))
+    elif isinstance(obj, (list, tuple)):
+        return tuple(_canonical(item) for item in obj)
+    elif isinstance(obj, (set, frozenset)):
+        return ('set', tuple(sorted((_canonical(item) for item in obj), key=repr)))
+    else:
+        return obj
+
+
+def request_key(route, args, kwargs):
+    """
+    Canonical hash of a rendering request.
+    Requests with equal keys are expected to render identical images.
+    """
+    canonical = repr((route, _canonical(args), _canonical(kwargs)))
+    return hashlib.blake2b(canonical.encode(), digest_size=16).hexdigest()
+
+
 uuid_alphabet = string.ascii_lowercase + string.digits
 
 